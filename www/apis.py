@@ -2,15 +2,16 @@
 JSON API definition.
 '''
 
-import json, logging, inspect, functools
+import json, logging, inspect, functools, base64, hashlib
 
 
 ## 建立Page类来处理分页,可以在page_size更改每页项目的个数
 class Page(object):
 
-    def __init__(self, item_count, page_index=1, page_size=8):
+    def __init__(self, item_count, page_index=1, page_size=8, cursor=None, exact=True):
         '''
-        Init Pagination by item_count, page_index and page_size.
+        Init Pagination by item_count, page_index and page_size, or by an opaque cursor from a previous page.
+        exact is False when item_count is an estimate (see Model.findCount).
         >>> p1 = Page(100, 1)
         >>> p1.page_count
         10
@@ -34,6 +35,7 @@ class Page(object):
         10
         '''
         self.item_count = item_count
+        self.exact = exact
         self.page_size = page_size
         self.page_count = item_count // page_size + (1 if item_count % page_size > 0 else 0)
         if (item_count == 0) or (page_index > self.page_count):
@@ -46,13 +48,92 @@ class Page(object):
             self.limit = self.page_size
         self.has_next = self.page_index < self.page_count
         self.has_previous = self.page_index > 1
+        self.next_cursor = None
+        self.prev_cursor = None
+        self._seek = None
+        if cursor:#游标模式: 按(created_at, id)定位,不再扫描丢弃offset行
+            direction, values, self.page_index = decode_cursor(cursor)
+            self._seek = {direction: values}
+            self.offset = 0
+            self.limit = self.page_size
+
+    def find_kw(self):
+        '''
+        Keyword arguments for Model.findAll to fetch this page.
+        >>> Page(100, 3, 10).find_kw()
+        {'limit': (20, 10)}
+        >>> sorted(Page(100, cursor=encode_cursor('after', (1.5, 'a'), 2)).find_kw().items())
+        [('after', [1.5, 'a']), ('limit', 9)]
+        '''
+        if self._seek is None:
+            return dict(limit=(self.offset, self.limit))
+        kw = dict(self._seek)
+        kw['limit'] = self.limit + 1#多取一行用来判断是否还有下一页
+        return kw
+
+    def paginate(self, items, keys=('created_at', 'id')):
+        '''
+        Trim the probe row of cursor mode and fill next_cursor/prev_cursor from the first and last items.
+        '''
+        items = list(items)
+        if self._seek is not None:
+            more = len(items) > self.page_size
+            if 'after' in self._seek:
+                items = items[:self.page_size]
+                self.has_next, self.has_previous = more, True
+            else:
+                items = items[-self.page_size:]
+                self.has_next, self.has_previous = True, more
+        if items:
+            if self.has_next:
+                self.next_cursor = encode_cursor('after', [getattr(items[-1], k) for k in keys], self.page_index + 1)
+            if self.has_previous:
+                self.prev_cursor = encode_cursor('before', [getattr(items[0], k) for k in keys], self.page_index - 1)
+        return items
 
     def __str__(self):
-        return 'item_count: %s, page_count: %s, page_index: %s, page_size: %s, offset: %s, limit: %s' % (self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
+        return 'item_count: %s, exact: %s, page_count: %s, page_index: %s, page_size: %s, offset: %s, limit: %s' % (self.item_count, self.exact, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
 
     __repr__ = __str__
 
 
+def encode_cursor(direction, values, page_index):
+    '''
+    Encode a keyset position as an opaque, url-safe cursor token.
+    >>> decode_cursor(encode_cursor('after', (1528.25, '0015a'), 3))
+    ('after', [1528.25, '0015a'], 3)
+    '''
+    s = json.dumps([direction, list(values), page_index], separators=(',', ':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    '''
+    Decode a cursor token into (direction, values, page_index), raise APIValueError if it is malformed.
+    '''
+    try:
+        s = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        direction, values, page_index = json.loads(s.decode('utf-8'))
+    except (ValueError, TypeError):
+        raise APIValueError('cursor', 'Invalid cursor.')
+    if direction not in ('after', 'before') or not isinstance(values, list) or len(values) != 2 or not isinstance(page_index, int):
+        raise APIValueError('cursor', 'Invalid cursor.')
+    return direction, values, max(page_index, 1)
+
+
+def _version_default(o):#紧凑行由__json__给出字段
+    f = getattr(o, '__json__', None)
+    return f() if f is not None else str(o)
+
+def etag(*versions):
+    '''
+    A strong ETag for the version data of a response: model rows, stamps, page numbers...
+    >>> etag(1, {'id': 'a'}) == etag(1, {'id': 'a'}), etag(1, {'id': 'a'}) == etag(2, {'id': 'a'})
+    (True, False)
+    '''
+    s = json.dumps(versions, sort_keys=True, separators=(',', ':'), default=_version_default)
+    return '"%s"' % hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+
 class APIError(Exception):
     '''
     the base APIError which contains error(required), data(optional) and message(optional).
@@ -1,12 +1,15 @@
 
 import logging;logging.basicConfig(level=logging.INFO)
-import orm
-import asyncio,os,json,time
+import orm, metrics, compress, cache
+import asyncio,os,json,time,hashlib
+from email.utils import formatdate
 from datetime import datetime
 from aiohttp import web
 from jinja2 import Environment, FileSystemLoader
 from coroweb import add_routes, add_static
 from handlers import cookie2user, COOKIE_NAME
+from apis import etag
+from config import configs
 
 
 def init_jinja2(app, **kw):
@@ -33,27 +36,32 @@ def init_jinja2(app, **kw):
 async def logger_factory(app, handler):
     async def logger(request):
         logging.info('Request: %s %s' % (request.method, request.path))
+        resource = getattr(request.match_info.route, 'resource', None)
+        metrics.current_route.set('%s %s' % (request.method, getattr(resource, 'canonical', request.path)))#慢查询记录发起它的路由
         # await asyncio.sleep(0.3)
         return (await handler(request))
     return logger
 
-@asyncio.coroutine
-def auth_factory(app, handler):
-    @asyncio.coroutine
-    def auth(request):
+async def auth_factory(app, handler):#从cookie解出当前用户,放在request.__user__上
+    async def auth(request):
         logging.info('check user: %s %s' % (request.method, request.path))
         request.__user__ = None
         cookie_str = request.cookies.get(COOKIE_NAME)
         if cookie_str:
-            user = yield from cookie2user(cookie_str)
+            user = await cookie2user(cookie_str)
             if user:
                 logging.info('set current user: %s' % user.email)
                 request.__user__ = user
         if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
             return web.HTTPFound('/signin')
-        return (yield from handler(request))
+        return (await handler(request))
     return auth
 
+async def identity_map_factory(app, handler):#每个请求一个身份映射,同一主键的对象只查一次
+    async def identity_map(request):
+        with orm.identity_map():
+            return (await handler(request))
+    return identity_map
 
 async def data_factory(app, handler):
     async def parse_data(request):
@@ -67,6 +75,45 @@ async def data_factory(app, handler):
         return (await handler(request))
     return parse_data
 
+def json_default(o):#紧凑行(orm.CompactRow)没有__dict__,由__json__给出字段
+    f = getattr(o, '__json__', None)
+    if f is not None:
+        return f()
+    return dict((k, v) for k, v in o.__dict__.items() if not k.startswith('_'))#下划线开头的是内部状态,不输出
+
+def etag_matches(request, tag):
+    ' whether a GET/HEAD request lists tag in If-None-Match; weak tags and the -gzip/-br suffix of compress_factory also match. '
+    header = request.headers.get('If-None-Match')
+    if not header or request.method not in ('GET', 'HEAD'):
+        return False
+    for t in header.split(','):
+        t = t.strip()
+        if t.startswith('W/'):
+            t = t[2:]
+        for suffix in ('-gzip"', '-br"'):
+            if t.endswith(suffix):
+                t = t[:-len(suffix)] + '"'
+        if t == '*' or t == tag:
+            return True
+    return False
+
+## 带校验器的响应: 浏览器可以缓存,但每次都要带 If-None-Match 回来确认,不按 Last-Modified 自己估算新鲜期
+REVALIDATE = 'no-cache'
+
+def not_modified(request, tag, last_modified=None):
+    ' a 304 carrying the ETag the 200 would carry: compress_factory skips 304s, so add its -<encoding> suffix here. '
+    encoding = compress.choose_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is not None and tag.endswith('"'):
+        encoded = '%s-%s"' % (tag[:-1], encoding)
+        if encoded in request.headers.get('If-None-Match', ''):#客户端拿到的是压缩过的表示(太小的响应不压缩,没有后缀)
+            tag = encoded
+    resp = web.Response(status=304)
+    resp.headers['ETag'] = tag
+    resp.headers['Cache-Control'] = REVALIDATE
+    if last_modified is not None:
+        resp.headers['Last-Modified'] = formatdate(last_modified, usegmt=True)
+    return resp
+
 async def response_factory(app, handler):#将整个的css和js以及html都返回给了浏览器
     async def response(request):
         logging.info('Response handler...')
@@ -86,14 +133,31 @@ async def response_factory(app, handler):#将整个的css和js以及html都返
             return resp
         if isinstance(r, dict):
             template = r.get('__template__')
+            tag = r.pop('__etag__', None)#处理函数按数据版本给出的ETag,命中时不渲染模板也不序列化
+            last_modified = r.pop('__last_modified__', None)
+            if tag is not None:
+                if template is not None:#页面里有当前用户
+                    user = getattr(request, '__user__', None)
+                    tag = etag(tag, user.id if user else None)
+                if etag_matches(request, tag):
+                    return not_modified(request, tag, last_modified)
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=json_default).encode('utf-8'))
                 resp.content_type = 'application/json;charset=utf-8'
-                return resp
             else:
                 resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
                 resp.content_type = 'text/html;charset=utf-8'
-                return resp
+            if tag is None and request.method == 'GET':#没有版本信息时用响应体的摘要,至少省下传输
+                tag = '"%s"' % hashlib.sha1(resp.body).hexdigest()
+                if etag_matches(request, tag):
+                    return not_modified(request, tag)
+            if tag is not None:
+                resp.headers['ETag'] = tag
+            if last_modified is not None:#只作提示,304只看If-None-Match: 日志修改不会推后created_at
+                resp.headers['Last-Modified'] = formatdate(last_modified, usegmt=True)
+            if tag is not None or last_modified is not None:
+                resp.headers['Cache-Control'] = REVALIDATE
+            return resp
         if isinstance(r, int) and r >= 100 and r < 600:
             return web.Response(r)
         if isinstance(r, tuple) and len(r) == 2:
@@ -106,6 +170,83 @@ async def response_factory(app, handler):#将整个的css和js以及html都返
         return resp
     return response
 
+async def page_cache_factory(app, handler):#未登录访客看到的页面都一样,整页缓存渲染结果
+    page_cache = app.get('__page_cache__')
+
+    def store(key, r, generation):
+        if type(r) is web.Response and r.status == 200 and r.body is not None and r.content_type == 'text/html':
+            page_cache.put(key, (r.body, r.headers.get('Content-Type'), r.headers.get('ETag'), r.headers.get('Last-Modified')), generation)
+        return r
+
+    async def refresh(request, key):#过期但仍可用的页面先返回旧的,后台重新渲染
+        generation = page_cache.generation#渲染前读取,渲染期间的失效才能挡住旧页面
+        headers = request.headers.copy()
+        for name in ('If-None-Match', 'If-Modified-Since'):#后台渲染要完整页面,不能是客户端条件请求的304
+            headers.popall(name, None)
+        try:
+            store(key, await handler(request.clone(headers=headers)), generation)
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            page_cache.refreshing.discard(key)
+
+    async def cached_page(request):
+        if page_cache is None or request.method != 'GET' or COOKIE_NAME in request.cookies:
+            return (await handler(request))
+        key = request.path_qs
+        page, fresh = page_cache.lookup(key)
+        if page is None:
+            page_cache.misses += 1
+            generation = page_cache.generation
+            return store(key, await handler(request), generation)
+        if fresh:
+            page_cache.hits += 1
+        else:
+            page_cache.stale_hits += 1
+            if key not in page_cache.refreshing:
+                page_cache.refreshing.add(key)
+                page_cache.spawn(refresh(request, key))
+        body, content_type, tag, last_modified = page
+        if tag is not None and etag_matches(request, tag):
+            resp = not_modified(request, tag)
+            tag = resp.headers['ETag']
+        else:
+            resp = web.Response(body=body)
+            resp.headers['Content-Type'] = content_type
+        for name, value in (('ETag', tag), ('Last-Modified', last_modified)):
+            if value is not None:
+                resp.headers[name] = value
+                resp.headers['Cache-Control'] = REVALIDATE
+        return resp
+    return cached_page
+
+## 超过此字节数的响应放到线程池里压缩,不阻塞事件循环
+COMPRESS_IN_EXECUTOR = 64 * 1024
+
+async def compress_factory(app, handler):#压缩 response_factory 生成的响应,静态文件由 add_static 直接给出预压缩版本
+    async def compress_response(request):
+        r = await handler(request)
+        if type(r) is not web.Response or r.body is None or r.status < 200 or r.status in (204, 304):
+            return r
+        if 'Content-Encoding' in r.headers or len(r.body) < compress.MIN_SIZE or not compress.compressible(r.content_type):
+            return r
+        r.headers['Vary'] = 'Accept-Encoding'
+        encoding = compress.choose_encoding(request.headers.get('Accept-Encoding'))
+        if encoding is None:
+            return r
+        body = r.body
+        if len(body) > COMPRESS_IN_EXECUTOR:
+            body = await asyncio.get_event_loop().run_in_executor(None, compress.compress, body, encoding)
+        else:
+            body = compress.compress(body, encoding)
+        r.body = body
+        r.headers['Content-Encoding'] = encoding
+        tag = r.headers.get('ETag')
+        if tag is not None and tag.endswith('"'):#强ETag对应一种编码,压缩后的表示用另一个ETag
+            r.headers['ETag'] = '%s-%s"' % (tag[:-1], encoding)
+        return r
+    return compress_response
+
 def datetime_filter(t):
     delta = int(time.time() - t)
     if delta < 60:
@@ -119,15 +260,26 @@ def datetime_filter(t):
     dt = datetime.fromtimestamp(t)
     return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
 
-async def init(loop):
-    await orm.create_pool(loop=loop, host='127.0.0.1', port=3306, user='root', password='123456', db='awesome')
+async def create_app(loop, page_cache=None, **kw):
+    '''
+    create the connection pool (kw goes to orm.create_pool) and the application with all routes;
+    page_cache=dict(maxsize=, ttl=, stale=) caches the pages of anonymous visitors.
+    '''
+    await orm.create_pool(loop=loop, **kw)
     app = web.Application(loop=loop, middlewares=[
-        logger_factory, response_factory
+        logger_factory, identity_map_factory, auth_factory, compress_factory, page_cache_factory, response_factory
     ])
+    if page_cache is not None:
+        app['__page_cache__'] = cache.PageCache(**page_cache)
+        metrics.register_gauge('page_cache', app['__page_cache__'].stats)
 
     init_jinja2(app, filters=dict(datetime=datetime_filter))
     add_routes(app, 'handlers')
     add_static(app)
+    return app
+
+async def init(loop):
+    app = await create_app(loop, page_cache=configs.get('page_cache'), host='127.0.0.1', port=3306, user='root', password='123456', db='awesome')
     srv = await loop.create_server(app.make_handler(), '127.0.0.1', 9000)
     logging.info('server started at http://127.0.0.1:9000...')
     return srv
@@ -0,0 +1,191 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Microbenchmarks for the hot paths of the web stack. Run: python3 bench.py [name ...]
+The app benchmark serves handlers.py in-process on the orm sqlite backend.
+'''
+
+import sys, time, timeit, asyncio, logging
+
+import orm
+from models import Blog
+
+
+def report(name, fn, number=100000):
+    t = min(timeit.repeat(fn, number=number, repeat=5))
+    print('%-40s %10.0f ops/s %8.3f us/op' % (name, number / t, t / number * 1e6))
+    return t
+
+
+## 旧的拼接方式: 每次调用都重新拼接 SQL 并替换占位符
+def legacy_findall_sql(cls, where=None, orderBy=None, limit=None):
+    sql = [cls.__select__]
+    if where:
+        sql.append('where')
+        sql.append(where)
+    if orderBy:
+        sql.append('order by')
+        sql.append(orderBy)
+    if limit is not None:
+        sql.append('limit')
+        sql.append('?, ?')
+    return ' '.join(sql).replace('?', '%s')
+
+## 实测缓存版快约 1.1-1.6 倍(两者都在 1 微秒以内,视机器而定),省下的主要是每次拼接和替换占位符的开销
+def bench_sql():
+    old = report('findAll sql, rebuilt per call', lambda: legacy_findall_sql(Blog, 'user_id=?', 'created_at desc', (0, 10)))
+    new = report('findAll sql, shape cache', lambda: orm._compile(Blog._findAllSql(Blog.__eager__, 'user_id=?', 'created_at desc', 2, None)))
+    print('%-40s %10.2fx' % ('speedup', old / new))
+
+## 整个应用跑在进程内的 SQLite 内存库上,不需要 MySQL
+async def seed(blogs=200, comments=5):
+    import schema
+    from models import User, Comment
+    await schema.create_schema()
+    user = User(name='bench', email='bench@example.com', passwd='x', image='about:blank', admin=True)
+    await user.save()
+    L = [Blog(user_id=user.id, user_name=user.name, user_image=user.image, name='blog %d' % n, summary='summary', content='content ' * 200) for n in range(blogs)]
+    await Blog.saveMany(L)
+    await Comment.saveMany([Comment(blog_id=b.id, user_id=user.id, user_name=user.name, user_image=user.image, content='comment') for b in L for n in range(comments)])
+    return L
+
+async def throughput(client, name, path, total=2000, concurrency=20):
+    async def worker(n):
+        for i in range(n):
+            resp = await client.get(path)
+            await resp.read()
+            assert resp.status == 200, (path, resp.status)
+    t = time.monotonic()
+    await asyncio.gather(*[worker(total // concurrency) for n in range(concurrency)])
+    t = time.monotonic() - t
+    print('%-40s %10.0f req/s %8.3f ms/req' % (name, total / t, t / total * 1e3))
+
+def bench_app():
+    from aiohttp.test_utils import TestServer, TestClient
+    import app as webapp
+    logging.getLogger().setLevel(logging.WARNING)
+    async def run(loop):
+        application = await webapp.create_app(loop, backend='sqlite', db=':memory:')
+        blogs = await seed()
+        client = TestClient(TestServer(application, loop=loop), loop=loop)
+        await client.start_server()
+        try:
+            await throughput(client, 'GET / (page 1)', '/')
+            await throughput(client, 'GET /api/blogs?page=5', '/api/blogs?page=5')
+            await throughput(client, 'GET /blog/{id}', '/blog/%s' % blogs[0].id)
+            await throughput(client, 'GET /api/comments', '/api/comments')
+        finally:
+            await client.close()
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(loop))
+
+## 旧的通用取参路径: 每个请求都按签名分支、循环复制参数、把参数字典转成字符串写日志
+class LegacyRequestHandler(object):
+    def __init__(self, fn):
+        from coroweb import has_request_arg, has_var_kw_arg, has_named_kw_args, get_named_kw_args, get_required_kw_args
+        self._func = fn
+        self._has_request_arg = has_request_arg(fn)
+        self._has_var_kw_arg = has_var_kw_arg(fn)
+        self._has_named_kw_args = has_named_kw_args(fn)
+        self._named_kw_args = get_named_kw_args(fn)
+        self._required_kw_args = get_required_kw_args(fn)
+
+    async def __call__(self, request):
+        from urllib import parse
+        from aiohttp import web
+        kw = None
+        if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
+            if request.method == 'POST':
+                if not request.content_type:
+                    return web.HTTPBadRequest("Missing Content-Type")
+                ct = request.content_type.lower()
+                if ct.startswith('application/json'):
+                    params = await request.json()
+                    if not isinstance(params, dict):
+                        return web.HTTPBadRequest('JSON body must be object.')
+                    kw = params
+                elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+                    params = await request.post()
+                    kw = dict(**params)
+                else:
+                    return web.HTTPBadRequest("Unsupported Content-Type: %s" % request.content_type)
+            if request.method == "GET":
+                qs = request.query_string
+                if qs:
+                    kw = dict()
+                    for k, v in parse.parse_qs(qs, True).items():
+                        kw[k] = v[0]
+        if kw is None:
+            kw = dict(**request.match_info)
+        else:
+            if not self._has_var_kw_arg and self._named_kw_args:
+                copy = dict()
+                for name in self._named_kw_args:
+                    if name in kw:
+                        copy[name] = kw[name]
+                kw = copy
+            for k, v in request.match_info.items():
+                if k in kw:
+                    logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
+                kw[k] = v
+        if self._has_request_arg:
+            kw['request'] = request
+        if self._required_kw_args:
+            for name in self._required_kw_args:
+                if not name in kw:
+                    return web.HTTPBadRequest('Missing argument: %s' % name)
+        logging.info('call with args: %s' % str(kw))
+        try:
+            r = await self._func(**kw)
+            return r
+        except:
+            return dict(error="ApiError")
+
+class FakeRequest(object):
+    def __init__(self, method='GET', query_string='', match_info=None, content_type=None, data=None):
+        self.method = method
+        self.query_string = query_string
+        self.match_info = match_info or dict()
+        self.content_type = content_type
+        self._data = data
+
+    async def json(self):
+        return self._data
+
+async def calls_per_second(handler, request, number=50000):
+    t = time.monotonic()
+    for n in range(number):
+        await handler(request)
+    return number / (time.monotonic() - t)
+
+def bench_binder():
+    from coroweb import get, post, RequestHandler
+    logging.getLogger().setLevel(logging.WARNING)
+    @get('/api/blogs')
+    async def api_blogs(*, page='1', cursor=None):
+        return page
+    @get('/blog/{id}')
+    async def get_blog(id):
+        return id
+    @post('/api/blogs/{id}/comments')
+    async def api_create_comment(id, request, *, content):
+        return content
+    cases = [
+        ('GET /api/blogs?page=2', api_blogs, FakeRequest(query_string='page=2')),
+        ('GET /blog/{id}', get_blog, FakeRequest(match_info=dict(id='1'))),
+        ('POST /api/blogs/{id}/comments', api_create_comment, FakeRequest('POST', match_info=dict(id='1'), content_type='application/json', data=dict(content='hi')))
+    ]
+    loop = asyncio.get_event_loop()
+    for name, fn, request in cases:
+        old = loop.run_until_complete(calls_per_second(LegacyRequestHandler(fn), request))
+        new = loop.run_until_complete(calls_per_second(RequestHandler(None, fn, fn.__route__), request))
+        print('%-40s %10.0f -> %10.0f req/s %8.2fx' % (name, old, new, new / old))
+
+BENCHMARKS = dict(sql=bench_sql, app=bench_app, binder=bench_binder)
+
+
+if '__main__' == __name__:
+    for name in sys.argv[1:] or BENCHMARKS.keys():
+        print('== %s' % name)
+        BENCHMARKS[name]()
@@ -0,0 +1,275 @@
+'''
+Read-through cache backends for Model.find: an in-process LRU with TTL, and a client for a memcached
+text-protocol server shared by several worker processes. Run python3 cache.py [port] for a local stand-in server.
+PageCache keeps rendered pages for app.py.
+
+A backend provides the coroutines get(namespace, key), set(namespace, key, value, ttl), delete(namespace, key)
+and clear(namespace); values are JSON-serializable rows.
+'''
+
+import asyncio, collections, hashlib, json, logging, sys, time
+
+
+class LRUCache(object):
+    '''
+    Least recently used entries with a per-entry time to live, in this process only.
+    >>> c = LRUCache(2)
+    >>> for k in 'abc': c.put(('t', k), k, 60)
+    >>> c.peek(('t', 'a')), c.peek(('t', 'c')), len(c)
+    (None, 'c', 2)
+    '''
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()#键 ==> (过期时间, 值),最近用过的在末尾
+
+    def __len__(self):
+        return len(self._data)
+
+    def peek(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, value, ttl):
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def get(self, namespace, key):
+        return self.peek((namespace, key))
+
+    async def set(self, namespace, key, value, ttl):
+        self.put((namespace, key), value, ttl)
+
+    async def delete(self, namespace, key):
+        self._data.pop((namespace, key), None)
+
+    async def clear(self, namespace):
+        for k in [k for k in self._data if k[0] == namespace]:
+            del self._data[k]
+
+
+class MemcachedCache(object):
+    '''
+    Client of a memcached text-protocol server, one connection with requests in turn.
+    clear() bumps a per-namespace generation that is part of every key, so old entries are never read again;
+    other processes keep using the generation they read for up to generation_ttl seconds.
+    Keys are hashed, so a key taken from a URL can't smuggle a command into the text protocol.
+    Connection errors, requests slower than timeout seconds and undecodable values are logged and read as misses:
+    the cache never fails a query. Any interrupted request drops the connection, so a late reply can't be read
+    by the next one.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=11211, prefix='orm', timeout=0.5, generation_ttl=1.0):
+        self.host = host
+        self.port = port
+        self.prefix = prefix
+        self.timeout = timeout
+        self.generation_ttl = generation_ttl
+        self._generations = dict()#命名空间 ==> (过期时间, 代数),省掉每次 get/set 前的一次往返
+        self._lock = asyncio.Lock()
+        self._reader = self._writer = None
+
+    async def _request(self, command, reply):
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        self._writer.write(command)
+        await self._writer.drain()
+        return await reply(self._reader)
+
+    async def _call(self, command, reply):
+        async with self._lock:
+            try:
+                return await asyncio.wait_for(self._request(command, reply), self.timeout)
+            except (OSError, EOFError, ValueError, IndexError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                logging.warning('memcached %s:%s unavailable: %s' % (self.host, self.port, str(e) or type(e).__name__))
+                self.close()
+                return None
+            except BaseException:#被取消时回复可能还没读完,留着连接下一个请求会读到它
+                self.close()
+                raise
+
+    async def _get_raw(self, key):
+        async def reply(reader):
+            value = None
+            while True:
+                line = await reader.readline()
+                if not line:
+                    raise EOFError('connection closed')
+                if line == b'END\r\n':
+                    return value
+                parts = line.split()#VALUE <键> <标志> <字节数>
+                if len(parts) != 4 or parts[0] != b'VALUE' or parts[1] != raw:
+                    raise ValueError('unexpected reply %r' % line)
+                data = await reader.readexactly(int(parts[3]) + 2)
+                value = data[:-2]
+        raw = key.encode('utf-8')
+        return await self._call(b'get ' + raw + b'\r\n', reply)
+
+    async def _store(self, command, key, data, ttl):
+        async def reply(reader):
+            return await reader.readline()
+        head = '%s %s 0 %d %d' % (command, key, int(ttl), len(data))
+        return await self._call(head.encode('utf-8') + b'\r\n' + data + b'\r\n', reply)
+
+    async def _generation(self, namespace):
+        entry = self._generations.get(namespace)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        gen = await self._get_raw('%s:gen:%s' % (self.prefix, namespace))
+        gen = gen.decode('ascii', 'replace') if gen else '0'
+        self._generations[namespace] = (time.monotonic() + self.generation_ttl, gen)
+        return gen
+
+    async def _key(self, namespace, key):#键可能来自URL,摘要后不含空白和控制字符,长度也固定
+        digest = hashlib.sha1(str(key).encode('utf-8')).hexdigest()
+        return '%s:%s:%s:%s' % (self.prefix, namespace, await self._generation(namespace), digest)
+
+    async def get(self, namespace, key):
+        data = await self._get_raw(await self._key(namespace, key))
+        if data is None:
+            return None
+        try:
+            return json.loads(data.decode('utf-8'))
+        except ValueError as e:
+            logging.warning('memcached %s:%s bad value for %s %s: %s' % (self.host, self.port, namespace, key, e))
+            return None
+
+    async def set(self, namespace, key, value, ttl):
+        await self._store('set', await self._key(namespace, key), json.dumps(value, ensure_ascii=False).encode('utf-8'), ttl)
+
+    async def delete(self, namespace, key):
+        async def reply(reader):
+            return await reader.readline()
+        await self._call(('delete %s\r\n' % await self._key(namespace, key)).encode('utf-8'), reply)
+
+    async def clear(self, namespace):
+        gen = str(time.time_ns())
+        self._generations[namespace] = (time.monotonic() + self.generation_ttl, gen)
+        await self._store('set', '%s:gen:%s' % (self.prefix, namespace), gen.encode('ascii'), 0)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+
+class PageCache(object):
+    '''
+    Rendered pages by path and query, fresh for ttl seconds and then, with stale > 0, served for stale more
+    seconds while one request refreshes them in the background.
+    For settle seconds after an invalidation no page is stored: a render then may have read a replica that
+    has not seen the write yet.
+    >>> c = PageCache(ttl=10, stale=0)
+    >>> c.put('/blog/1?x=1', 'page'); c.put('/', 'home')
+    >>> c.lookup('/blog/1?x=1'), c.invalidate('/blog/1'), c.lookup('/blog/1?x=1'), c.lookup('/')
+    (('page', True), None, (None, False), ('home', True))
+    '''
+
+    def __init__(self, maxsize=1000, ttl=10, stale=0, settle=1.0):
+        self.ttl = ttl
+        self.stale = stale
+        self.settle = settle
+        self.refreshing = set()#正在后台刷新的键,每个键同时只刷新一次
+        self.tasks = set()#后台刷新的任务,事件循环只持有弱引用,不留着可能被回收
+        self.invalidated = None#最近一次失效的时间
+        self.hits = self.misses = self.stale_hits = 0
+        self.generation = 0#每次失效加一,失效前开始渲染的页面不再存入
+        self._lru = LRUCache(maxsize)
+
+    def lookup(self, key):
+        ' return (value, fresh); value is None on a miss. '
+        entry = self._lru.peek(key)
+        if entry is None:
+            return None, False
+        created, value = entry
+        return value, time.monotonic() - created < self.ttl
+
+    def put(self, key, value, generation=None):
+        ' store a page, unless the cache was invalidated since generation was read. '
+        self.refreshing.discard(key)
+        if generation is not None and generation != self.generation:
+            return
+        if self.invalidated is not None and time.monotonic() - self.invalidated < self.settle:
+            return
+        self._lru.put(key, (time.monotonic(), value), self.ttl + self.stale)
+
+    def invalidate(self, path=None):
+        ' drop the pages of path with any query, or every page when path is None. '
+        self.generation += 1
+        self.invalidated = time.monotonic()
+        if path is None:
+            self._lru._data.clear()
+            return
+        for k in [k for k in self._lru._data if k == path or k.startswith(path + '?')]:
+            del self._lru._data[k]
+
+    def spawn(self, coro):
+        ' run coro in the background, holding its task until it is done. '
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def stats(self):
+        return dict(size=len(self._lru), hits=self.hits, stale_hits=self.stale_hits, misses=self.misses)
+
+
+## 本地替身服务器: 只实现 get/set/delete,数据放在一个 LRUCache 里
+async def handle_memcached(reader, writer, store):
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            parts = line.decode('utf-8').split()
+            if not parts:
+                continue
+            if parts[0] == 'get':
+                for k in parts[1:]:
+                    v = store.peek(k)
+                    if v is not None:
+                        writer.write(('VALUE %s 0 %d\r\n' % (k, len(v))).encode('utf-8') + v + b'\r\n')
+                writer.write(b'END\r\n')
+            elif parts[0] == 'set' and len(parts) >= 5:
+                try:
+                    size, ttl = int(parts[4]), int(parts[3])
+                    if size < 0:
+                        raise ValueError(parts[4])
+                except ValueError:#字节数不对就找不到数据的结尾,只能断开
+                    writer.write(b'CLIENT_ERROR bad command line format\r\n')
+                    break
+                data = (await reader.readexactly(size + 2))[:-2]
+                store.put(parts[1], data, ttl if ttl > 0 else 365 * 86400)
+                writer.write(b'STORED\r\n')
+            elif parts[0] == 'delete' and len(parts) >= 2:
+                found = store.peek(parts[1]) is not None
+                store._data.pop(parts[1], None)
+                writer.write(b'DELETED\r\n' if found else b'NOT_FOUND\r\n')
+            else:
+                writer.write(b'ERROR\r\n')
+            await writer.drain()
+    except (ConnectionError, UnicodeDecodeError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(host='127.0.0.1', port=11211, maxsize=100000):
+    store = LRUCache(maxsize)
+    return await asyncio.start_server(lambda r, w: handle_memcached(r, w, store), host, port)
+
+
+if '__main__' == __name__:
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 11211
+    loop.run_until_complete(serve(port=port))
+    logging.info('memcached stand-in listening on 127.0.0.1:%d...' % port)
+    loop.run_forever()
@@ -0,0 +1,105 @@
+'''
+Content-Encoding negotiation and compression for responses and static files.
+
+    python3 compress.py [dir]   write .gz (and .br with the brotli module) siblings of the static files
+'''
+
+import gzip, os, sys, logging
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+## 按优先顺序排列,服务器支持的编码
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+## 预压缩文件的后缀
+SUFFIXES = dict(br='.br', gzip='.gz')
+
+## 值得压缩的类型,图片字体等本身已压缩
+COMPRESS_TYPES = ('text/html', 'text/plain', 'text/css', 'application/json', 'application/javascript', 'text/javascript', 'image/svg+xml')
+COMPRESS_EXTENSIONS = ('.html', '.txt', '.css', '.json', '.js', '.svg')
+
+## 小于此字节数的响应不压缩,压缩省下的比不上额外开销
+MIN_SIZE = 1024
+
+
+def accepted_encodings(header):
+    '''
+    Parse an Accept-Encoding header into the set of encodings with a non-zero q value.
+    >>> sorted(accepted_encodings('gzip, deflate;q=0.5, br;q=0'))
+    ['deflate', 'gzip']
+    '''
+    accepted = set()
+    for part in (header or '').lower().split(','):
+        token, _, params = part.strip().partition(';')
+        q = params.strip()
+        if q.startswith('q='):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if token:
+            accepted.add(token)
+    return accepted
+
+def choose_encoding(header, available=ENCODINGS):
+    '''
+    The first of available that the client accepts, or None.
+    >>> choose_encoding('gzip, br', ('br', 'gzip')), choose_encoding('identity', ('br', 'gzip'))
+    ('br', None)
+    '''
+    accepted = accepted_encodings(header)
+    for enc in available:
+        if enc in accepted or '*' in accepted:
+            return enc
+    return None
+
+def compressible(content_type):
+    return (content_type or '').split(';')[0].strip().lower() in COMPRESS_TYPES
+
+def compress(data, encoding, level=6):
+    if encoding == 'br':
+        return brotli.compress(data, quality=min(level, 11))
+    return gzip.compress(data, level)
+
+
+def up_to_date(path, encoding):
+    ' whether the compressed sibling of path exists and is not older than path itself. '
+    target = path + SUFFIXES[encoding]
+    return os.path.isfile(target) and os.path.getmtime(target) >= os.path.getmtime(path)
+
+def precompress(root, min_size=MIN_SIZE):
+    ' write compressed siblings of the text files under root that are missing or older than their source. '
+    written = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            if not name.endswith(COMPRESS_EXTENSIONS):
+                continue
+            path = os.path.join(dirpath, name)
+            if os.path.getsize(path) < min_size:
+                continue
+            data = None
+            for enc in ENCODINGS:
+                target = path + SUFFIXES[enc]
+                if up_to_date(path, enc):
+                    continue
+                if data is None:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                body = compress(data, enc, 11 if enc == 'br' else 9)
+                if len(body) >= len(data):
+                    continue
+                with open(target, 'wb') as f:
+                    f.write(body)
+                written += 1
+                logging.info('%s: %d => %d bytes' % (target, len(data), len(body)))
+    return written
+
+
+if '__main__' == __name__:
+    logging.basicConfig(level=logging.INFO)
+    root = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    print('%d files written.' % precompress(root))
@@ -10,5 +10,11 @@ configs ={
     },
     'session':{
         'secret':'AwEsOmE'
+    },
+    'page_cache':{
+        'maxsize':1000,
+        'ttl':10,
+        'stale':30,
+        'settle':1
     }
 }
\ No newline at end of file
@@ -1,12 +1,14 @@
-import asyncio,os,inspect,logging,functools
+import asyncio,os,re,types,inspect,logging,functools,mimetypes
 
 from urllib import parse
 from aiohttp import web
+from apis import APIError, APIValueError
+import compress
 
 
-def get(path):
+def get(path, **validators):
     '''
-    Define decorator @get('/path')
+    Define decorator @get('/path'), optionally with parameter validators: @get('/path', page=Int(min=1))
     '''
     def decorator(func):
         @functools.wraps(func)
@@ -14,12 +16,13 @@ def get(path):
             return func(*args, **kw)
         wrapper.__method__ = 'GET'
         wrapper.__route__ = path
+        wrapper.__validators__ = validators
         return wrapper
     return decorator
 
-def post(path):
+def post(path, **validators):
     '''
-    Define decorator @post('/path')
+    Define decorator @post('/path'), optionally with parameter validators: @post('/path', name=Str())
     '''
     def decorator(func):
         @functools.wraps(func)
@@ -27,9 +30,89 @@ def post(path):
             return func(*args, **kw)
         wrapper.__method__ = 'POST'
         wrapper.__route__ = path
+        wrapper.__validators__ = validators
         return wrapper
     return decorator
 
+## 参数校验: 在 @get/@post 的关键字参数或参数注解里声明,add_route 时编进取参函数
+class Validator(object):
+    '''
+    Base of the parameter constraints: calling it with (name, value) returns the converted value
+    or raises APIValueError(name, message).
+    '''
+    def __init__(self, message=''):
+        self.message = message
+
+    def fail(self, name):
+        raise APIValueError(name, self.message)
+
+class Int(Validator):
+    '''
+    Integer within [min, max]; with fallback, malformed or out-of-range input becomes fallback instead of an error.
+    >>> page = Int(min=1, fallback=1)
+    >>> page('page', '3'), page('page', '0'), page('page', 'x')
+    (3, 1, 1)
+    '''
+    def __init__(self, min=None, max=None, fallback=None, message=''):
+        super(Int, self).__init__(message)
+        self.min = min
+        self.max = max
+        self.fallback = fallback
+
+    def __call__(self, name, value):
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            value = None
+        if value is None or (self.min is not None and value < self.min) or (self.max is not None and value > self.max):
+            if self.fallback is not None:
+                return self.fallback
+            self.fail(name)
+        return value
+
+class Str(Validator):
+    '''
+    String of min_len to max_len characters, stripped first by default, so Str() means "not blank".
+    '''
+    def __init__(self, strip=True, min_len=1, max_len=None, message=''):
+        super(Str, self).__init__(message)
+        self.strip = strip
+        self.min_len = min_len
+        self.max_len = max_len
+
+    def __call__(self, name, value):
+        if not isinstance(value, str):
+            self.fail(name)
+        if self.strip:
+            value = value.strip()
+        if len(value) < self.min_len or (self.max_len is not None and len(value) > self.max_len):
+            self.fail(name)
+        return value
+
+class Regex(Str):
+    '''
+    String matching a pattern (a compiled regex or its source), not stripped by default.
+    '''
+    def __init__(self, pattern, strip=False, message=''):
+        super(Regex, self).__init__(strip, 1, None, message)
+        self.pattern = re.compile(pattern) if isinstance(pattern, str) else pattern
+
+    def __call__(self, name, value):
+        value = super(Regex, self).__call__(name, value)
+        if not self.pattern.match(value):
+            self.fail(name)
+        return value
+
+def get_validators(fn):
+    ' the validators of fn by parameter name: @get/@post keyword arguments first, then Validator annotations. '
+    params = inspect.signature(fn).parameters
+    validators = dict((name, p.annotation) for name, p in params.items() if isinstance(p.annotation, Validator))
+    for name, v in getattr(fn, '__validators__', dict()).items():
+        if name not in params:
+            raise ValueError('validator for unknown parameter %s in function: %s' % (name, fn.__name__))
+        validators[name] = v
+    return validators
+
 def get_required_kw_args(fn):
     args = []
     params = inspect.signature(fn).parameters
@@ -70,65 +153,82 @@ def has_request_arg(fn):
             raise ValueError('request parameter must be the last named parameter in function: %s%s' % (fn.__name__, str(sig)))
     return found
 
+_RE_ROUTE_ARG = re.compile(r'\{(\w+)(?::[^{}]*)?\}')#路径中的 {id} 或 {id:正则}
+
+def make_binder(fn, path):
+    '''
+    Generate handler(request) for fn at add_route time: the argument extraction that suits its signature
+    is written out as straight-line code, so a request does no signature checks and no kw loops.
+    '''
+    named_kw_args = get_named_kw_args(fn)
+    required_kw_args = get_required_kw_args(fn)
+    var_kw_arg = has_var_kw_arg(fn)
+    match_args = _RE_ROUTE_ARG.findall(path)
+    validators = get_validators(fn)
+    unwrapped = inspect.unwrap(fn)#@get/@post 包了一层普通函数,要看原函数
+    if inspect.isgeneratorfunction(unwrapped):#yield from 写法的旧式协程
+        fn = types.coroutine(unwrapped)
+    is_async = asyncio.iscoroutinefunction(fn) or asyncio.iscoroutinefunction(unwrapped) or inspect.isgeneratorfunction(unwrapped)
+    L = ['async def handler(request):', '    kw = dict()']
+    if var_kw_arg or named_kw_args:#只有需要关键字参数的函数才读请求体和查询串
+        L.extend([
+            '    params = None',
+            "    if request.method == 'POST':",
+            '        if not request.content_type:',
+            "            return web.HTTPBadRequest('Missing Content-Type')",
+            '        ct = request.content_type.lower()',
+            "        if ct.startswith('application/json'):",
+            '            params = await request.json()',
+            '            if not isinstance(params, dict):',
+            "                return web.HTTPBadRequest('JSON body must be object.')",
+            "        elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):",
+            '            params = await request.post()',
+            '        else:',
+            "            return web.HTTPBadRequest('Unsupported Content-Type: %s' % request.content_type)",
+            "    elif request.method == 'GET':",
+            '        qs = request.query_string',
+            '        if qs:',
+            '            params = dict((k, v[0]) for k, v in parse_qs(qs, True).items())',
+            '    if params is not None:'])
+        if var_kw_arg:
+            L.append('        kw.update(params)')
+        else:
+            for name in named_kw_args:
+                L.append('        if %r in params: kw[%r] = params[%r]' % (name, name, name))
+    for name in match_args:
+        if var_kw_arg or name in named_kw_args:
+            L.append("    if %r in kw: logging.warning('Duplicate arg name in named arg and kw args: %s')" % (name, name))
+        L.append('    kw[%r] = request.match_info[%r]' % (name, name))
+    if has_request_arg(fn):
+        L.append("    kw['request'] = request")
+    for name in required_kw_args:
+        if name not in match_args:
+            L.append("    if %r not in kw: return web.HTTPBadRequest('Missing argument: %s')" % (name, name))
+    L.extend([
+        "    logging.info('call with args: %s', kw)",#惰性格式化,INFO关闭时不把参数转成字符串
+        '    try:'])
+    for name in validators:#校验在处理函数之前,不合法的请求碰不到数据库
+        L.append('        if %r in kw: kw[%r] = validators[%r](%r, kw[%r])' % (name, name, name, name, name))
+    L.extend([
+        '        return %sfn(**kw)' % ('await ' if is_async else ''),
+        '    except APIError as e:',
+        '        return dict(error=e.error, data=e.data, message=e.message)',
+        '    except:',
+        "        return dict(error = 'ApiError')"])
+    namespace = dict(fn=fn, web=web, logging=logging, parse_qs=parse.parse_qs, validators=validators, APIError=APIError)
+    exec('\n'.join(L), namespace)
+    handler = namespace['handler']
+    handler.__source__ = '\n'.join(L)
+    return handler
+
 class RequestHandler(object):#fn为主，request为副，副以主要求为准传递数据
-    def __init__(self,app,fn):
+    def __init__(self,app,fn,path=''):
         self._app = app
         self._func = fn
-        self._has_request_arg = has_request_arg(fn)#检验URL处理函数的参数,检查是否有request名字的参数
-        self._has_var_kw_arg = has_var_kw_arg(fn)#检验函数是否有 可变关键字参数
-        self._has_named_kw_args = has_named_kw_args(fn)#检验是否有 必须关键字参数
-        self._named_kw_args = get_named_kw_args(fn)# 拿到 必须关键字参数
-        self._required_kw_args = get_required_kw_args(fn)#拿到 要求的必须关键字参数
+        self._bind = make_binder(fn, path)#按fn的签名生成专用的取参函数,请求到来时直接调用
 
     async def __call__(self,request):#RequestHandler实例对所有的URL处理函数都有了充分的理解与处理后，等待确定了method和path的request传入后交给对应fn
-        kw = None
-        if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:#该URL处理函数有 可变关键字参数或必须关键字参数
-            if request.method == 'POST':#判断传入的 request 属于哪一路后 提取出 request中的数据
-                if not request.content_type:# None时，排除异常
-                    return web.HTTPBadRequest("Missing Content-Type")
-                ct = request.content_type.lower()
-                if ct.startswith('application/json'):
-                    params = await request.json()
-                    if not isinstance(params,dict):
-                        return web.HTTPBadRequest('JSON body must be object.')
-                    kw = params
-                elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
-                    params = await request.post()
-                    kw = dict(**params)#POST法最终出来的是一个 dict
-                else:
-                    return web.HTTPBadRequest("Unsupported Content-Type: %s"%request.content_type)
-            if request.method == "GET":
-                qs = request.query_string
-                if qs:
-                    kw = dict()#GET法最终出来的是一个 dict
-                    for k,v in parse.parse_qs(qs,True).items():
-                        kw[k] = v[0]
-        if kw is None:#不是 POST和 GET请求
-            kw = dict(**request.match_info)
-        else:
-            if not self._has_var_kw_arg and self._named_kw_args:#进一步筛选 同时有 可变关键参和必须关键参的
-                copy = dict()
-                for name in self._named_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
-
-            for k,v in request.match_info.items():
-                if k in kw:
-                    logging.warning('Duplicate arg name in named arg and kw args: %s'%k)
-                kw[k] = v
-        if self._has_request_arg:#有 request命名的参数的处理函数则继续添加参数至kw
-            kw['request'] = request
-        if self._required_kw_args:
-            for name in self._required_kw_args:
-                if not name in kw:
-                    return web.HTTPBadRequest('Missing argument: %s'%name)
-        logging.info('call with args: %s'%str(kw))
-        try:#以上就是将request中的相关参数提取出来后对应 fn
-            r = await self._func(**kw)#URL处理函数连接点
-            return r
-        except:
-            return dict(error = "ApiError")
+        return (await self._bind(request))
 
 
 def add_route(app,fn):
@@ -136,10 +236,8 @@ def add_route(app,fn):
     path = getattr(fn,'__route__',None)
     if path is None or method is None:
         raise ValueError('@get or @post not defined in %s.'% str(fn))
-    if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
-        fn = asyncio.coroutine(fn)
     logging.info('add route %s %s => %s(%s)'%(method,path,fn.__name__,', '.join(inspect.signature(fn).parameters.keys())))
-    app.router.add_route(method,path,RequestHandler(app,fn))#参考app.py里的内容，关键点在注册好后调用，这里是全自动扫描注册,都是依据此语句构建的框架
+    app.router.add_route(method,path,RequestHandler(app,fn,path))#参考app.py里的内容，关键点在注册好后调用，这里是全自动扫描注册,都是依据此语句构建的框架
     #貌似 RequestHandler(app,fn)只是初始化了一个实例，每一个路径都对应一个实例，该实例引用有call函数等待request传来后被RequestHandler(app,fn)(request)调用
     #即将处理函数fn接入到Web.app中,RequestHandler的初始化都是检查fn的，即server端，只待request的到来.
     #method和path的确定就选定了对应的URL处理函数了
@@ -161,8 +259,25 @@ def add_routes(app,module_name):#专门将一整个py文件中的函数动态加
             if method and path:
                 add_route(app,fn)
 
+class StaticHandler(object):#优先返回客户端接受的预压缩文件(compress.py 生成的 .br/.gz),比原文件旧的不用
+    def __init__(self, root):
+        self._root = root
+
+    async def __call__(self, request):
+        path = os.path.normpath(os.path.join(self._root, request.match_info['filename']))
+        if not path.startswith(self._root + os.sep) or not os.path.isfile(path):
+            raise web.HTTPNotFound()
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if compress.compressible(content_type):
+            encoding = compress.choose_encoding(request.headers.get('Accept-Encoding'), [e for e in compress.ENCODINGS if compress.up_to_date(path, e)])
+            if encoding is not None:
+                return web.FileResponse(path + compress.SUFFIXES[encoding], headers={'Content-Type': content_type, 'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'})
+            return web.FileResponse(path, headers={'Content-Type': content_type, 'Vary': 'Accept-Encoding'})
+        return web.FileResponse(path)
+
 def add_static(app):
     path = os.path.join(os.path.dirname(os.path.abspath(__file__)),'static')
-    app.router.add_static('/static/',path)
+    handler = StaticHandler(path)
+    app.router.add_route('GET','/static/{filename:.+}',handler)
+    app.router.add_route('HEAD','/static/{filename:.+}',handler)#FileResponse 对 HEAD 只发响应头
     logging.info('add static %s=>%s'%('/static/',path))
-
@@ -3,10 +3,11 @@ import re, time, json, logging, hashlib, base64, asyncio
 ## markdown 是处理日志文本的一种格式语法，具体语法使用请百度
 import markdown
 from aiohttp import web
-from coroweb import get, post
+import orm, metrics
+from coroweb import get, post, Int, Str, Regex
 
 ## 分页管理以及调取API时的错误信息
-from apis import Page, APIValueError, APIResourceNotFoundError,APIPermissionError,APIError
+from apis import Page, APIValueError, APIResourceNotFoundError,APIPermissionError,APIError, etag
 from models import User, Comment, Blog, next_id
 from config import configs
 
@@ -18,16 +19,8 @@ def check_admin(request):
     if request.__user__ is None or not request.__user__.admin:
         raise APIPermissionError()
 
-## 获取页码信息
-def get_page_index(page_str):
-    p = 1
-    try:
-        p = int(page_str)
-    except ValueError as e:
-        pass
-    if p < 1:
-        p = 1
-    return p
+## 页码参数: 不合法或小于1时取第1页
+_PAGE = Int(min=1, fallback=1)
 
 ## 计算加密cookie
 def user2cookie(user, max_age):
@@ -60,24 +53,44 @@ async def cookie2user(cookie_str):
         if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
             logging.info('invalid sha1')
             return None
+        user = user.clone()#遮盖密码不能改动本次请求身份映射里共享的对象
         user.passwd = '******'
         return user
     except Exception as e:
         logging.exception(e)
         return None
 
+## 数据修改后让整页缓存失效,path为None时清空全部页面
+def invalidate_pages(request, path=None):
+    page_cache = request.app.get('__page_cache__')
+    if page_cache is not None:
+        page_cache.invalidate(path)
+
+## 模板渲染时才转换的markdown文本,304响应不必转换
+class LazyMarkdown(object):
+    def __init__(self, text):
+        self._text = text
+        self._html = None
+
+    def __html__(self):#jinja2的safe过滤器调用__html__,多处引用只转换一次
+        if self._html is None:
+            self._html = markdown.markdown(self._text)
+        return self._html
+
+    __str__ = __html__
+
 ## 处理首页URL
-@get('/')
-async def index(*, page='1'):
-    page_index = get_page_index(page)
-    num = await Blog.findNumber('count(id)')
-    p = Page(num, page_index)
+@get('/', page=_PAGE)
+async def index(*, page=1, cursor=None):
+    num, exact = await Blog.findCount()
+    p = Page(num, page, cursor=cursor, exact=exact)
     if num == 0:
         blogs = []
     else:
-        blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+        blogs = p.paginate(await Blog.findAll(orderBy='created_at desc, id desc', compact=True, **p.find_kw()))
     return {
         '__template__': 'blogs.html',
+        '__etag__': etag(str(p), blogs),
         'page': p,
         'blogs': blogs
     }
@@ -85,13 +98,16 @@ async def index(*, page='1'):
 ## 处理日志详情页面URL
 @get('/blog/{id}')
 async def get_blog(id):
-    blog = await Blog.find(id)
-    comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
+    blog = await Blog.find(id, prefetch=('comments',))#日志与评论两条查询同时进行
+    comments = blog.comments
+    tag = etag(blog)#含预取的评论
     for c in comments:
-        c.html_content = markdown.markdown(c.content)
-    blog.html_content = markdown.markdown(blog.content)
+        c.html_content = LazyMarkdown(c.content)
+    blog.html_content = LazyMarkdown(blog.content)
     return {
         '__template__': 'blog.html',
+        '__etag__': tag,
+        '__last_modified__': max([blog.created_at] + [c.created_at for c in comments]),
         'blog': blog,
         'comments': comments
     }
@@ -111,12 +127,8 @@ def signin():
     }
 
 ## 用户登录验证API
-@post('/api/authenticate')
+@post('/api/authenticate', email=Str(strip=False, message='Invalid email.'), passwd=Str(strip=False, message='Invalid password.'))
 async def authenticate(*, email, passwd):
-    if not email:
-        raise APIValueError('email', 'Invalid email.')
-    if not passwd:
-        raise APIValueError('passwd', 'Invalid password.')
     users = await User.findAll('email=?', [email])
     if len(users) == 0:
         raise APIValueError('email', 'Email not exist.')
@@ -151,19 +163,19 @@ def manage():
     return 'redirect:/manage/comments'
 
 ## 评论管理页面
-@get('/manage/comments')
-def manage_comments(*, page='1'):
+@get('/manage/comments', page=_PAGE)
+def manage_comments(*, page=1):
     return {
         '__template__': 'manage_comments.html',
-        'page_index': get_page_index(page)
+        'page_index': page
     }
 
 ## 日志管理页面
-@get('/manage/blogs')
-def manage_blogs(*, page='1'):
+@get('/manage/blogs', page=_PAGE)
+def manage_blogs(*, page=1):
     return {
         '__template__': 'manage_blogs.html',
-        'page_index': get_page_index(page)
+        'page_index': page
     }
 
 ## 创建日志页面
@@ -185,37 +197,35 @@ def manage_edit_blog(*, id):
     }
 
 ## 用户管理页面
-@get('/manage/users')
-def manage_users(*, page='1'):
+@get('/manage/users', page=_PAGE)
+def manage_users(*, page=1):
     return {
         '__template__': 'manage_users.html',
-        'page_index': get_page_index(page)
+        'page_index': page
     }
 
 ## 获取评论信息API
-@get('/api/comments')
-async def api_comments(*, page='1'):
-    page_index = get_page_index(page)
-    num = await Comment.findNumber('count(id)')
-    p = Page(num, page_index)
+@get('/api/comments', page=_PAGE)
+async def api_comments(*, page=1, cursor=None):
+    num, exact = await Comment.findCount()
+    p = Page(num, page, cursor=cursor, exact=exact)
     if num == 0:
         return dict(page=p, comments=())
-    comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    comments = p.paginate(await Comment.findAll(orderBy='created_at desc, id desc', compact=True, **p.find_kw()))
     return dict(page=p, comments=comments)
 
 ## 用户发表评论API
-@post('/api/blogs/{id}/comments')
+@post('/api/blogs/{id}/comments', content=Str())
 async def api_create_comment(id, request, *, content):
     user = request.__user__
     if user is None:
         raise APIPermissionError('Please signin first.')
-    if not content or not content.strip():
-        raise APIValueError('content')
     blog = await Blog.find(id)
     if blog is None:
         raise APIResourceNotFoundError('Blog')
-    comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip())
+    comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content)
     await comment.save()
+    invalidate_pages(request, '/blog/%s' % blog.id)
     return comment
 
 ## 管理员删除评论API
@@ -226,41 +236,52 @@ async def api_delete_comments(id, request):
     if c is None:
         raise APIResourceNotFoundError('Comment')
     await c.remove()
+    invalidate_pages(request, '/blog/%s' % c.blog_id)
     return dict(id=id)
 
 ## 获取用户信息API
-@get('/api/users')
-async def api_get_users(*, page='1'):
-    page_index = get_page_index(page)
-    num = await User.findNumber('count(id)')
-    p = Page(num, page_index)
+@get('/api/users', page=_PAGE)
+async def api_get_users(*, page=1, cursor=None):
+    num, exact = await User.findCount()
+    p = Page(num, page, cursor=cursor, exact=exact)
     if num == 0:
         return dict(page=p, users=())
-    users = await User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    users = p.paginate(await User.findAll(orderBy='created_at desc, id desc', compact=True, **p.find_kw()))
     for u in users:
         u.passwd = '******'
     return dict(page=p, users=users)
 
+## 数据库连接池与语句耗时指标API
+@get('/api/metrics')
+def api_metrics(request):
+    check_admin(request)
+    return metrics.snapshot()
+
+## 慢查询记录API
+@get('/api/metrics/slow')
+def api_slow_queries(request):
+    check_admin(request)
+    r = web.Response(body=metrics.slow_log.dump().encode('utf-8'))
+    r.content_type = 'application/json;charset=utf-8'
+    return r
+
 ## 定义EMAIL和HASH的格式规范
 _RE_EMAIL = re.compile(r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
 _RE_SHA1 = re.compile(r'^[0-9a-f]{40}$')
 
 ## 用户注册API
-@post('/api/users')
+@post('/api/users', email=Regex(_RE_EMAIL), name=Str(), passwd=Regex(_RE_SHA1))
 async def api_register_user(*, email, name, passwd):#连接ORM验证
-    if not name or not name.strip():
-        raise APIValueError('name')
-    if not email or not _RE_EMAIL.match(email):
-        raise APIValueError('email')
-    if not passwd or not _RE_SHA1.match(passwd):
-        raise APIValueError('passwd')
+    uid = next_id()
+    sha1_passwd = '%s:%s' % (uid, passwd)
+    # 已部署的库未必建了 email 的唯一索引(只在 models.py 里声明),先查一次,确认线上都有索引前不能去掉
     users = await User.findAll('email=?', [email])
     if len(users) > 0:
         raise APIError('register:failed', 'email', 'Email is already in use.')
-    uid = next_id()
-    sha1_passwd = '%s:%s' % (uid, passwd)
-    user = User(id=uid, name=name.strip(), email=email, passwd=hashlib.sha1(sha1_passwd.encode('utf-8')).hexdigest(), image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email.encode('utf-8')).hexdigest())
-    await user.save()
+    user = User(id=uid, name=name, email=email, passwd=hashlib.sha1(sha1_passwd.encode('utf-8')).hexdigest(), image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email.encode('utf-8')).hexdigest())
+    # 有唯一索引时,查询和插入之间的并发注册由它挡住
+    if await user.upsert(update=(), conflict=('email',)) == 0:
+        raise APIError('register:failed', 'email', 'Email is already in use.')
     # make session cookie:
     r = web.Response()
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
@@ -270,51 +291,42 @@ async def api_register_user(*, email, name, passwd):#连接ORM验证
     return r
 
 ## 获取日志列表API
-@get('/api/blogs')
-async def api_blogs(*, page='1'):
-    page_index = get_page_index(page)
-    num = await Blog.findNumber('count(id)')
-    p = Page(num, page_index)
+@get('/api/blogs', page=_PAGE)
+async def api_blogs(*, page=1, cursor=None):
+    num, exact = await Blog.findCount()
+    p = Page(num, page, cursor=cursor, exact=exact)
     if num == 0:
         return dict(page=p, blogs=())
-    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    blogs = p.paginate(await Blog.findAll(orderBy='created_at desc, id desc', compact=True, **p.find_kw()))
     return dict(page=p, blogs=blogs)
 
 ## 获取日志详情API
 @get('/api/blogs/{id}')
 async def api_get_blog(*, id):
     blog = await Blog.find(id)
-    return blog
+    if blog is None:
+        return blog
+    return dict(blog, __etag__=etag(blog), __last_modified__=blog.created_at)
 
 ## 发表日志API
-@post('/api/blogs')
+@post('/api/blogs', name=Str(message='name cannot be empty.'), summary=Str(message='summary cannot be empty.'), content=Str(message='content cannot be empty.'))
 async def api_create_blog(request, *, name, summary, content):
     check_admin(request)
-    if not name or not name.strip():
-        raise APIValueError('name', 'name cannot be empty.')
-    if not summary or not summary.strip():
-        raise APIValueError('summary', 'summary cannot be empty.')
-    if not content or not content.strip():
-        raise APIValueError('content', 'content cannot be empty.')
-    blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image, name=name.strip(), summary=summary.strip(), content=content.strip())
+    blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image, name=name, summary=summary, content=content)
     await blog.save()
+    invalidate_pages(request)
     return blog
 
 ## 编辑日志API
-@post('/api/blogs/{id}')
+@post('/api/blogs/{id}', name=Str(message='name cannot be empty.'), summary=Str(message='summary cannot be empty.'), content=Str(message='content cannot be empty.'))
 async def api_update_blog(id, request, *, name, summary, content):
     check_admin(request)
     blog = await Blog.find(id)
-    if not name or not name.strip():
-        raise APIValueError('name', 'name cannot be empty.')
-    if not summary or not summary.strip():
-        raise APIValueError('summary', 'summary cannot be empty.')
-    if not content or not content.strip():
-        raise APIValueError('content', 'content cannot be empty.')
-    blog.name = name.strip()
-    blog.summary = summary.strip()
-    blog.content = content.strip()
+    blog.name = name
+    blog.summary = summary
+    blog.content = content
     await blog.update()
+    invalidate_pages(request)
     return blog
 
 ## 删除日志API
@@ -323,24 +335,19 @@ async def api_delete_blog(request, *, id):
     check_admin(request)
     blog = await Blog.find(id)
     await blog.remove()
+    invalidate_pages(request)
     return dict(id=id)
 
 ## 删除用户API
 @post('/api/users/{id}/delete')
 async def api_delete_users(id, request):
     check_admin(request)
-    id_buff = id
-    user = await User.find(id)
-    if user is None:
-        raise APIResourceNotFoundError('Comment')
-    await user.remove()
-    # 给被删除的用户在评论中标记
-    comments = await Comment.findAll('user_id=?',[id])
-    if comments:
-        for comment in comments:
-            id = comment.id
-            c = await Comment.find(id)
-            c.user_name = c.user_name + ' (该用户已被删除)'
-            await c.update()
-    id = id_buff
+    async with orm.transaction():
+        user = await User.find(id)
+        if user is None:
+            raise APIResourceNotFoundError('Comment')
+        await user.remove()
+        # 给被删除的用户在评论中标记
+        await Comment.updateWhere('`user_name`=concat(`user_name`, ?)', 'user_id=?', [' (该用户已被删除)', id])
+    invalidate_pages(request)#评论里的用户名变了
     return dict(id=id)
\ No newline at end of file
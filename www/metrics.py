@@ -0,0 +1,149 @@
+'''
+In-process metrics for the database layer: pool checkout wait, pool gauges, statement latency and errors,
+plus a bounded slow query log.
+'''
+
+import bisect, collections, contextvars, json, time
+
+## 秒为单位的直方图桶上界
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+## 统计的语句形状数上限,超出的归入 '(other)'
+MAX_SHAPES = 500
+
+
+class Histogram(object):
+    '''
+    Fixed-bucket histogram of durations in seconds.
+    >>> h = Histogram()
+    >>> for v in (0.0002, 0.003, 0.003, 0.2): h.observe(v)
+    >>> h.count, h.quantile(0.5), h.quantile(0.99)
+    (4, 0.005, 0.25)
+    '''
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        ' upper bound of the bucket holding the q-th quantile, max for the overflow bucket. '
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self):
+        return dict(count=self.count, sum=self.sum, max=self.max,
+                    p50=self.quantile(0.5), p95=self.quantile(0.95), p99=self.quantile(0.99),
+                    buckets=dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts)))
+
+
+_checkout_wait = Histogram()
+_statements = dict()#语句形状 ==> Histogram
+_errors = dict()#语句形状 ==> 出错次数
+_gauges = dict()#名称 ==> 返回当前值的函数
+
+
+def _shape(sql):
+    if sql in _statements or len(_statements) < MAX_SHAPES:
+        return sql
+    return '(other)'
+
+def observe_checkout(seconds):
+    ' record how long a caller waited for a pool connection. '
+    _checkout_wait.observe(seconds)
+
+def observe_statement(sql, seconds, error=False):
+    ' record the latency of one statement, keyed by its ? placeholder form. '
+    shape = _shape(sql)
+    h = _statements.get(shape)
+    if h is None:
+        h = _statements[shape] = Histogram()
+    h.observe(seconds)
+    if error:
+        _errors[shape] = _errors.get(shape, 0) + 1
+
+def register_gauge(name, fn):
+    ' register a function whose return value is reported under name by snapshot(). '
+    _gauges[name] = fn
+
+def snapshot():
+    ' return all metrics as plain, JSON-serializable data. '
+    r = dict(
+        checkout_wait=_checkout_wait.snapshot(),
+        statements=dict((k, h.snapshot()) for k, h in _statements.items()),
+        errors=dict(_errors)
+    )
+    for name, fn in _gauges.items():
+        r[name] = fn()
+    return r
+
+def reset():
+    global _checkout_wait
+    _checkout_wait = Histogram()
+    _statements.clear()
+    _errors.clear()
+
+
+## 当前请求的路由,由 app.py 的 logger_factory 设置,慢查询记录它
+current_route = contextvars.ContextVar('current_route', default=None)
+
+
+def redact(args):
+    '''
+    Replace statement arguments by their type (and length for strings), never logging values.
+    >>> redact(['a@b.c', 3, None])
+    ['<str:5>', '<int>', None]
+    '''
+    r = []
+    for a in args or ():
+        if a is None:
+            r.append(None)
+        elif isinstance(a, (str, bytes)):
+            r.append('<%s:%d>' % (type(a).__name__, len(a)))
+        else:
+            r.append('<%s>' % type(a).__name__)
+    return r
+
+
+class SlowQueryLog(object):
+    '''
+    Ring buffer of statements slower than threshold seconds; threshold None disables it.
+    With explain=True the orm also stores the EXPLAIN plan of slow selects.
+    '''
+
+    def __init__(self, threshold=0.2, explain=False, maxlen=200):
+        self.configure(threshold, explain, maxlen)
+
+    def configure(self, threshold=0.2, explain=False, maxlen=200):
+        self.threshold = threshold
+        self.explain = explain
+        self.entries = collections.deque(maxlen=maxlen)
+
+    def is_slow(self, seconds):
+        return self.threshold is not None and seconds >= self.threshold
+
+    def record(self, sql, args, seconds, plan=None):
+        self.entries.append(dict(sql=sql, args=redact(args), seconds=seconds, route=current_route.get(), at=time.time(), plan=plan))
+
+    def dump(self):
+        ' the recorded entries as a JSON string, oldest first. '
+        return json.dumps(list(self.entries), ensure_ascii=False, default=str)
+
+
+slow_log = SlowQueryLog()
@@ -1,15 +1,17 @@
 import time, uuid
 
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, Index, HasMany, BelongsTo, StringField, BooleanField, FloatField, TextField
 
 def next_id():
     return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
 
 class User(Model):#对应 User表
     __table__ = 'users'
+    __count_cache__ = dict(ttl=30)
+    __indexes__ = [Index('created_at', 'id')]#按创建时间分页
     # __table__,id,email等定义的变量及其值传到 metaclass中的attrs作为键值对存在
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    email = StringField(ddl='varchar(50)')
+    email = StringField(ddl='varchar(50)', unique=True)
     passwd = StringField(ddl='varchar(50)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
@@ -18,6 +20,9 @@ class User(Model):#对应 User表
 
 class Blog(Model):#对应 Blog表
     __table__ = 'blogs'
+    __count_cache__ = dict(ttl=10, estimate_above=100000)
+    __cache__ = dict(ttl=60, maxsize=10000)#详情页每次都按主键读,日志很少修改
+    __indexes__ = [Index('created_at', 'id')]
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
@@ -25,16 +30,22 @@ class Blog(Model):#对应 Blog表
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
+    content = TextField(deferred=True)
     created_at = FloatField(default=time.time)
 
+    comments = HasMany('Comment', 'blog_id', orderBy='`created_at` desc')#Blog.find(id, prefetch=('comments',))
+
 class Comment(Model):#对应 Comment表
     __table__ = 'comments'
+    __count_cache__ = dict(ttl=10, estimate_above=100000)
+    __indexes__ = [Index('created_at', 'id'), Index('blog_id', 'created_at')]#日志详情页按blog_id取评论
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    user_id = StringField(ddl='varchar(50)', index=True)
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
-    created_at = FloatField(default=time.time)
\ No newline at end of file
+    created_at = FloatField(default=time.time)
+
+    blog = BelongsTo('Blog', 'blog_id')
\ No newline at end of file
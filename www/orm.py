@@ -2,55 +2,417 @@
 # -*- coding: utf-8 -*-
 
 
-import asyncio, logging
+import asyncio, logging, re, time, contextlib, contextvars, itertools
 
-import aiomysql
+try:
+    import aiomysql
+except ImportError:#只用 sqlite 后端时不需要 aiomysql
+    aiomysql = None
+
+import metrics, cache
 
 
 def log(sql, args=()):
-    logging.info('SQL: %s' % sql)
+    logging.debug('SQL: %s', sql)#逐条语句只在debug级别输出,慢语句见 metrics.slow_log
+
+
+_SQL_CACHE_SIZE = 1024
+_sql_cache = dict()#'?'占位符语句 ==> 驱动的'%s'语句
+_shape_cache = dict()#(模型, where, orderBy, limit形式, 游标方向) ==> 拼好的语句
+
+
+def _compile(sql):
+    ' translate ? placeholders to the driver paramstyle, once per distinct statement. '
+    try:
+        return _sql_cache[sql]
+    except KeyError:
+        if len(_sql_cache) >= _SQL_CACHE_SIZE:#拼进了字面量的语句会无限增长,满了就整体清空
+            _sql_cache.clear()
+        compiled = _sql_cache[sql] = _backend.translate(sql)
+        return compiled
+
+
+def _cache_shape(key, sql):
+    if len(_shape_cache) >= _SQL_CACHE_SIZE:
+        _shape_cache.clear()
+    _shape_cache[key] = sql
+    return sql
 
 
 async def create_pool(loop, **kw):#异步连接池不用同步等待，不必频繁打开或关闭数据库连接，尽量复用
+    '''
+    Create the primary pool of backend 'mysql' (default) or 'sqlite', plus one pool per entry of
+    replicas=[dict(host=...), ...] for reads.
+    Replica entries inherit the primary settings they do not override.
+    replica_policy is 'round_robin' or 'least_busy'; read_your_writes is the number of seconds
+    reads stay on the primary after a write in the same request.
+    cache=cache.MemcachedCache(...) shares the Model.find cache between processes instead of one LRU per model.
+    '''
     logging.info('create database connection pool...')
-    global __pool
-    __pool = await aiomysql.create_pool(
-        host=kw.get('host', 'localhost'),
-        port=kw.get('port', 3306),
-        user=kw['user'],
-        password=kw['password'],
-        db=kw['db'],
-        charset=kw.get('charset', 'utf8'),
-        autocommit=kw.get('autocommit', True),
-        maxsize=kw.get('maxsize', 10),
-        minsize=kw.get('minsize', 1),
-        loop=loop
-    )
+    global __pool, __replicas, _replica_policy, _read_your_writes, _backend, _shared_cache
+    name = kw.get('backend', 'mysql')
+    if name not in _BACKENDS:
+        raise ValueError('Invalid backend value: %s' % str(name))
+    if name != _backend.name:#换了占位符风格,已翻译的语句作废
+        _sql_cache.clear()
+    _backend = _BACKENDS[name]()
+    __pool = await _create_pool(loop, kw)
+    __replicas = []
+    for r in kw.get('replicas', None) or ():
+        logging.info('create replica connection pool %s:%s...' % (r.get('host', kw.get('host', 'localhost')), r.get('port', kw.get('port', 3306))))
+        __replicas.append(await _create_pool(loop, dict(kw, **r)))
+    _replica_policy = kw.get('replica_policy', 'round_robin')
+    if _replica_policy not in ('round_robin', 'least_busy'):
+        raise ValueError('Invalid replica_policy value: %s' % str(_replica_policy))
+    _read_your_writes = kw.get('read_your_writes', 1.0)
+    _shared_cache = kw.get('cache', None)
+
+
+async def _create_pool(loop, kw):
+    return await _backend.create_pool(loop, kw)
+
+
+class MySQLBackend(object):
+    ' aiomysql pools; the ? placeholders of the orm become %s. '
+    name = 'mysql'
+    explain = 'explain '
+    estimate_rows = 'select table_rows _num_ from information_schema.tables where table_schema=database() and table_name=?'
+
+    def __init__(self):
+        if aiomysql is None:
+            raise ImportError('aiomysql is required by the mysql backend.')
+        self.Cursor, self.DictCursor, self.SSDictCursor = aiomysql.Cursor, aiomysql.DictCursor, aiomysql.SSDictCursor
+
+    def translate(self, sql):
+        return sql.replace('?', '%s')
+
+    def upsert(self, conflict, update):
+        ' the clause appended to an insert; mysql picks the conflicting unique key itself. '
+        if not update:#重复时什么也不做,影响行数为0
+            return 'on duplicate key update `%s`=`%s`' % (conflict[0], conflict[0])
+        return 'on duplicate key update %s' % ', '.join(map(lambda f: '`%s`=values(`%s`)' % (f, f), update))
+
+    async def create_pool(self, loop, kw):
+        return await aiomysql.create_pool(
+            host=kw.get('host', 'localhost'),
+            port=kw.get('port', 3306),
+            user=kw['user'],
+            password=kw['password'],
+            db=kw['db'],
+            charset=kw.get('charset', 'utf8'),
+            autocommit=kw.get('autocommit', True),
+            maxsize=kw.get('maxsize', 10),
+            minsize=kw.get('minsize', 1),
+            loop=loop
+        )
+
+
+class SQLiteBackend(object):
+    ' sqlite3 files or shared in-memory databases, for local benchmarks and tests; db is the file path or :memory:. '
+    name = 'sqlite'
+    explain = 'explain query plan '
+    estimate_rows = None
+
+    def __init__(self):
+        import sqlitepool
+        self._sqlitepool = sqlitepool
+        self.Cursor, self.DictCursor, self.SSDictCursor = sqlitepool.Cursor, sqlitepool.DictCursor, sqlitepool.SSDictCursor
+
+    def translate(self, sql):#sqlite3 本身就用 ? 占位符, limit ?, ? 的写法也相同
+        return sql
+
+    def upsert(self, conflict, update):
+        ' the clause appended to an insert; conflict must name the columns of a primary key or unique index. '
+        target = ', '.join(map(lambda f: '`%s`' % f, conflict))
+        if not update:
+            return 'on conflict(%s) do nothing' % target
+        return 'on conflict(%s) do update set %s' % (target, ', '.join(map(lambda f: '`%s`=excluded.`%s`' % (f, f), update)))
+
+    async def create_pool(self, loop, kw):
+        return await self._sqlitepool.create_pool(kw.get('db', ':memory:'), minsize=kw.get('minsize', 1), maxsize=kw.get('maxsize', 10), loop=loop)
+
+
+_BACKENDS = dict(mysql=MySQLBackend, sqlite=SQLiteBackend)
+
+
+class _DefaultBackend(object):
+    ' placeholder until create_pool picks a backend: translates like mysql so models can warm the SQL cache. '
+    name = 'mysql'
+
+    def translate(self, sql):
+        return sql.replace('?', '%s')
+
+
+_backend = _DefaultBackend()
+
+
+def backend_name():
+    return _backend.name
+
+
+__pool = None
+__replicas = []
+_replica_policy = 'round_robin'
+_read_your_writes = 1.0
+_next_replica = itertools.count()
+_last_write = contextvars.ContextVar('orm_last_write', default=None)#本次请求最近一次写入的时间
+
+
+def pool_stats():
+    ' gauges of every pool: size, in-use and idle connections. '
+    pools = [('primary', __pool)] if __pool is not None else []
+    pools.extend(('replica%d' % i, p) for i, p in enumerate(__replicas))
+    return [dict(name=name, maxsize=p.maxsize, size=p.size, in_use=p.size - p.freesize, idle=p.freesize) for name, p in pools]
+
+
+metrics.register_gauge('pools', pool_stats)
+
+
+def _read_pool():
+    ' choose the pool for a read: the primary right after a write, otherwise a replica. '
+    if not __replicas:
+        return __pool
+    last = _last_write.get()
+    if last is not None and time.monotonic() - last < _read_your_writes:
+        return __pool
+    if _replica_policy == 'least_busy':#空闲连接加可新建连接最多的那个
+        return max(__replicas, key=lambda p: p.freesize + p.maxsize - p.size)
+    return __replicas[next(_next_replica) % len(__replicas)]
 
 # async/await是在python3.5版么以及之后的版本中才能使用。2. async不能和yield同时使用。3.await只能作用于可等待对象
 #async/await的出现是为了协程，是为了区分生成器使编程更加明确,来提升Python中的异步编程体验
-async def select(sql, args, size=None):
-    log(sql, args)
-    global __pool
-    async with __pool.get() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            await cur.execute(sql.replace('?', '%s'), args or ())
-            if size:
-                rs = await cur.fetchmany(size)
+_tx = contextvars.ContextVar('orm_transaction', default=None)#当前协程上下文所在的事务
+
+
+@contextlib.asynccontextmanager
+async def _connection(readonly=False):
+    ' yield the connection pinned by the current transaction, or check one out of the pool. '
+    tx = _tx.get()
+    if tx is not None:#事务内的读写都留在主库的同一连接上
+        yield tx.conn
+        return
+    pool = _read_pool() if readonly else __pool
+    t = time.monotonic()
+    async with pool.get() as conn:
+        metrics.observe_checkout(time.monotonic() - t)
+        yield conn
+
+
+async def _acquire():
+    t = time.monotonic()
+    conn = await __pool.acquire()
+    metrics.observe_checkout(time.monotonic() - t)
+    return conn
+
+
+def _release(conn):
+    __pool.release(conn)
+
+
+class Transaction(object):
+    '''
+    One unit of work on a pinned connection, see transaction(). Nested blocks become savepoints.
+    Statements of one transaction share the connection, so do not run them concurrently.
+    '''
+
+    def __init__(self):
+        self.conn = None
+        self.savepoint = None
+        self._depth = 0
+        self._token = None
+        self._evict = set()#事务内写过的 (模型类, 主键),结束时再从查询缓存删一次
+
+    async def __aenter__(self):
+        parent = _tx.get()
+        if parent is not None:
+            self.conn = parent.conn
+            self._depth = parent._depth + 1
+            self._evict = parent._evict
+            self.savepoint = 'sp_%d' % self._depth
+            await self._run('savepoint `%s`' % self.savepoint)
+        else:
+            self.conn = await _acquire()
+            try:
+                await self.conn.begin()
+            except BaseException:
+                _release(self.conn)
+                raise
+        self._token = _tx.set(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        _tx.reset(self._token)
+        if self.savepoint is not None:
+            if exc_type is None:
+                await self._run('release savepoint `%s`' % self.savepoint)
             else:
-                rs = await cur.fetchall()
-        logging.info('rows returned: %s' % len(rs))
+                await self._run('rollback to savepoint `%s`' % self.savepoint)
+                _forget_all()
+            return False
+        try:
+            if exc_type is None:
+                await self.conn.commit()
+            else:
+                await self.conn.rollback()
+                _forget_all()
+        finally:
+            _release(self.conn)
+        for cls, pk in self._evict:#提交前别的请求可能又缓存了旧值
+            await _uncache(cls, pk)
+        return False
+
+    async def _run(self, sql):
+        log(sql)
+        async with self.conn.cursor() as cur:
+            await cur.execute(sql)
+
+
+_shared_cache = None#create_pool(cache=...) 给出的多进程共享缓存
+_find_caches = dict()#模型类 ==> 进程内 LRUCache
+_cache_stats = dict()#模型名 ==> [命中, 未命中]
+
+
+def _model_cache(cls):
+    if _shared_cache is not None:
+        return _shared_cache
+    c = _find_caches.get(cls)
+    if c is None:
+        c = _find_caches[cls] = cache.LRUCache(cls.__cache__.get('maxsize', 10000))
+    return c
+
+
+async def _uncache(cls, pk=None):
+    ' drop one cached row, or every row of a model when pk is None, after a write. '
+    if not cls.__cache__:
+        return
+    c = _model_cache(cls)
+    if pk is None:
+        await c.clear(cls.__table__)
+    else:
+        await c.delete(cls.__table__, str(pk))
+    tx = _tx.get()
+    if tx is not None:
+        tx._evict.add((cls, pk))
+
+
+def cache_stats():
+    ' hit and miss counters of the Model.find cache per model. '
+    r = dict()
+    for name, (hits, misses) in _cache_stats.items():
+        r[name] = dict(hits=hits, misses=misses, hit_ratio=hits / (hits + misses) if hits + misses else 0.0)
+    for cls, c in _find_caches.items():
+        r.setdefault(cls.__name__, dict())['size'] = len(c)
+    return r
+
+
+metrics.register_gauge('find_cache', cache_stats)
+
+
+def _forget_all():#回滚后内存中的对象可能与数据库不一致
+    m = _identity.get()
+    if m is not None:
+        m.clear()
+
+
+def transaction():
+    '''
+    async with orm.transaction() as tx: find/findAll/save/update/remove inside the block run on one connection
+    and are committed together, or rolled back if the block raises.
+    '''
+    return Transaction()
+
+
+_identity = contextvars.ContextVar('orm_identity_map', default=None)#当前请求的身份映射 (模型类, 主键) ==> 对象
+
+
+@contextlib.contextmanager
+def identity_map():
+    '''
+    with orm.identity_map(): find/findMany inside the block return the object already loaded for a primary key
+    without a query. Only objects with every column loaded are kept; writes through the orm evict stale ones.
+    '''
+    token = _identity.set(dict())
+    try:
+        yield
+    finally:
+        _identity.reset(token)
+
+
+def _forget(cls, pk=None):
+    ' evict one object, or every object of a model when pk is None, from the current identity map. '
+    m = _identity.get()
+    if m is None:
+        return
+    if pk is not None:
+        m.pop((cls, pk), None)
+        return
+    for k in [k for k in m if k[0] is cls]:
+        del m[k]
+
+
+async def select(sql, args, size=None, as_tuple=False, primary=False):
+    log(sql, args)
+    async with _connection(not primary) as conn:#primary=True 时不读从库,结果要跨请求缓存时用
+        async with conn.cursor(_backend.Cursor if as_tuple else _backend.DictCursor) as cur:
+            t = time.monotonic()
+            try:
+                await cur.execute(_compile(sql), args or ())
+                if size:
+                    rs = await cur.fetchmany(size)
+                else:
+                    rs = await cur.fetchall()
+            except Exception:
+                metrics.observe_statement(sql, time.monotonic() - t, True)
+                raise
+            elapsed = time.monotonic() - t
+            metrics.observe_statement(sql, elapsed)
+        if metrics.slow_log.is_slow(elapsed):
+            await _record_slow(conn, sql, args, elapsed)
+        logging.debug('rows returned: %s', len(rs))
         return rs
 
 
+async def select_iter(sql, args, batch_size=500):
+    ' stream rows through a server-side cursor, holding at most batch_size rows in memory. '
+    log(sql, args)
+    async with _connection(True) as conn:
+        async with conn.cursor(_backend.SSDictCursor) as cur:
+            t = time.monotonic()
+            try:
+                await cur.execute(_compile(sql), args or ())
+            except Exception:
+                metrics.observe_statement(sql, time.monotonic() - t, True)
+                raise
+            elapsed = time.monotonic() - t
+            metrics.observe_statement(sql, elapsed)#流式读取只计首包时间
+            if metrics.slow_log.is_slow(elapsed):
+                await _record_slow(None, sql, args, elapsed)#连接正被流式游标占用,不做EXPLAIN
+            while True:
+                rs = await cur.fetchmany(batch_size)
+                if not rs:
+                    break
+                for r in rs:
+                    yield r
+
+
 async def execute(sql, args, autocommit=True):
     log(sql)
-    async with __pool.get() as conn:
+    if _tx.get() is not None:#事务内由事务统一提交
+        autocommit = True
+    _last_write.set(time.monotonic())
+    async with _connection() as conn:
         if not autocommit:
             await conn.begin()
         try:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace('?', '%s'), args)
+            async with conn.cursor(_backend.DictCursor) as cur:
+                t = time.monotonic()
+                try:
+                    await cur.execute(_compile(sql), args)
+                except Exception:
+                    metrics.observe_statement(sql, time.monotonic() - t, True)
+                    raise
+                elapsed = time.monotonic() - t
+                metrics.observe_statement(sql, elapsed)
                 affected = cur.rowcount
             if not autocommit:
                 await conn.commit()
@@ -58,9 +420,47 @@ async def execute(sql, args, autocommit=True):
             if not autocommit:
                 await conn.rollback()
             raise
+        if metrics.slow_log.is_slow(elapsed):
+            await _record_slow(conn, sql, args, elapsed)
         return affected
 
 
+async def _record_slow(conn, sql, args, elapsed):
+    ' add a statement to the slow query log, with its EXPLAIN plan for selects when enabled. '
+    plan = None
+    if conn is not None and metrics.slow_log.explain and sql.lstrip()[:6].lower() == 'select':
+        try:
+            async with conn.cursor(_backend.DictCursor) as cur:
+                await cur.execute(_backend.explain + _compile(sql), args or ())
+                plan = await cur.fetchall()
+        except Exception as e:
+            plan = 'explain failed: %s' % e
+    logging.warning('slow query (%.3fs): %s' % (elapsed, sql))
+    metrics.slow_log.record(sql, args, elapsed, plan)
+
+
+_RE_ORDER_COLUMN = re.compile(r'^\s*`?(\w+)`?(?:\s+(asc|desc))?\s*$', re.IGNORECASE)
+
+
+_count_cache = dict()#行数缓存: {表名: {(selectField, where, args): (过期时间, 数目)}}
+
+
+def _cached_count(table, key):
+    hit = _count_cache.get(table, {}).get(key)
+    if hit is None or hit[0] < time.time():
+        return None
+    return (hit[1],)
+
+
+def _store_count(table, key, num, ttl):
+    _count_cache.setdefault(table, {})[key] = (time.time() + ttl, num)
+
+
+def invalidate_counts(table):
+    ' drop every cached count of a table, called on writes. '
+    _count_cache.pop(table, None)
+
+
 def create_args_string(num):
     L = []
     for n in range(num):
@@ -68,13 +468,58 @@ def create_args_string(num):
     return ', '.join(L)
 
 
+_row_classes = dict()
+
+
+def row_class(model, names):
+    '''
+    Return the compact row class of a model for the given column names: __slots__ instead of a dict,
+    filled positionally from a tuple cursor, read like a Model by templates and response_factory.
+    '''
+    key = (model, tuple(names))
+    cls = _row_classes.get(key)
+    if cls is not None:
+        return cls
+    names = key[1]
+    ns = dict()#按列顺序生成直线赋值的__init__,省去逐个setattr的循环
+    exec('def __init__(self, %s):\n%s' % (', '.join(names), ''.join('    self.%s = %s\n' % (n, n) for n in names)), ns)
+    attrs = dict(__slots__=names, __model__=model, __init__=ns['__init__'])
+    cls = _row_classes[key] = type('%sRow' % model.__name__, (CompactRow,), attrs)
+    return cls
+
+
+class CompactRow(object):
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return self.__slots__
+
+    def __json__(self):
+        return dict((k, getattr(self, k)) for k in self.__slots__)
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.__json__())
+
+
 class Field(object):
 
-    def __init__(self, name, column_type, primary_key, default):
+    def __init__(self, name, column_type, primary_key, default, deferred=False, index=False, unique=False):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        self.deferred = deferred#延迟加载: 列表查询默认不取该列
+        self.index = index or unique#单列索引,unique为唯一索引
+        self.unique = unique
 
     def __str__(self):
         return '<%s, %s:%s>' % (self.__class__.__name__, self.column_type, self.name)
@@ -82,32 +527,115 @@ class Field(object):
 
 class StringField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)'):
-        super().__init__(name, ddl, primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)', index=False, unique=False):
+        super().__init__(name, ddl, primary_key, default, index=index, unique=unique)
 
 
 class BooleanField(Field):
 
-    def __init__(self, name=None, default=False):
-        super().__init__(name, 'boolean', False, default)
+    def __init__(self, name=None, default=False, index=False):
+        super().__init__(name, 'boolean', False, default, index=index)
 
 
 class IntegerField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0):
-        super().__init__(name, 'bigint', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0, index=False, unique=False):
+        super().__init__(name, 'bigint', primary_key, default, index=index, unique=unique)
 
 
 class FloatField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0.0):
-        super().__init__(name, 'real', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0.0, index=False, unique=False):
+        super().__init__(name, 'real', primary_key, default, index=index, unique=unique)
 
 
 class TextField(Field):
 
-    def __init__(self, name=None, default=None):
-        super().__init__(name, 'text', False, default)
+    def __init__(self, name=None, default=None, deferred=False):
+        super().__init__(name, 'text', False, default, deferred)
+
+
+class Index(object):
+    '''
+    Index declaration for Model.__indexes__, e.g. Index('blog_id', 'created_at'); a plain tuple of names also works.
+    '''
+
+    def __init__(self, *columns, unique=False, name=None):
+        if not columns:
+            raise ValueError('Index needs at least one column.')
+        self.columns = tuple(columns)
+        self.unique = unique
+        self.name = name
+
+    def __str__(self):
+        return '<%s %s(%s)>' % ('UniqueIndex' if self.unique else 'Index', self.name, ', '.join(self.columns))
+
+
+_models = dict()#模型名 ==> 模型类,关系可以用名字引用后面才定义的模型
+
+
+class Relation(object):
+    ' a relation to another model, given as the class or its name; loaded with prefetch=, see Model.findAll. '
+
+    def __init__(self, model, foreign_key, orderBy=None):
+        self._model = model
+        self.foreign_key = foreign_key
+        self.orderBy = orderBy
+
+    @property
+    def model(self):
+        if isinstance(self._model, str):
+            self._model = _models[self._model]
+        return self._model
+
+
+class HasMany(Relation):
+    '''
+    Rows of model whose foreign_key holds this primary key, e.g. Blog.comments = HasMany('Comment', 'blog_id');
+    prefetched as a list.
+    '''
+
+    def local_key(self, owner):
+        return owner.__primary_key__
+
+    def empty(self):
+        return []
+
+    async def fetch(self, keys, chunk_size=500):
+        target = self.model
+        columns = target._columns(None, True)
+        found = dict()
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            sql = '%s where `%s` in (%s)' % (target._selectHead(columns), self.foreign_key, create_args_string(len(chunk)))
+            if self.orderBy:
+                sql = '%s order by %s' % (sql, self.orderBy)
+            for r in await select(sql, chunk):
+                found.setdefault(r[self.foreign_key], []).append(target._register(target._fromRow(r), columns))
+        return found
+
+
+class BelongsTo(Relation):
+    '''
+    The row of model whose primary key is held by this foreign_key, e.g. Comment.blog = BelongsTo('Blog', 'blog_id');
+    prefetched as an object or None.
+    '''
+
+    def local_key(self, owner):
+        return self.foreign_key
+
+    def empty(self):
+        return None
+
+    async def fetch(self, keys):
+        return dict(zip(keys, await self.model.findMany(keys)))
+
+
+async def _gather(coros):
+    ' run independent queries concurrently on separate pool connections, or in turn on the connection of a transaction. '
+    if _tx.get() is not None:
+        return [await c for c in coros]
+    return await asyncio.gather(*coros)
 
 
 class ModelMetaclass(type):#目的是产生一个类实例，传递给子类init
@@ -142,6 +670,8 @@ class ModelMetaclass(type):#目的是产生一个类实例，传递给子类init
         attrs['__table__'] = tableName
         attrs['__primary_key__'] = primaryKey  # 主键属性名,主键只可能有一个
         attrs['__fields__'] = fields  # 除主键外的属性名
+        attrs['__deferred__'] = [f for f in fields if mappings[f].deferred]  # 延迟加载的列
+        attrs['__eager__'] = tuple([primaryKey] + [f for f in fields if not mappings[f].deferred])  # 列表查询默认取的列
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (
         tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
@@ -150,20 +680,85 @@ class ModelMetaclass(type):#目的是产生一个类实例，传递给子类init
         tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
         #即'update `blogs` set `user_id`=?, `user_name`=?, `user_image`=?, `name`=?, `summary`=?, `content`=?, `created_at`=? where `id`=?'
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)#返回的是类实例，类似于类产生实例那样，然后该实例调用类的init方法，这个类实例也就是init里的self
+        indexes = [Index(k, unique=v.unique) for k, v in mappings.items() if v.index and not v.primary_key]
+        for i in attrs.get('__indexes__', ()):#组合索引声明
+            indexes.append(i if isinstance(i, Index) else Index(*i))
+        for i in indexes:
+            for c in i.columns:
+                if c not in mappings:
+                    raise Exception('Index column not found in %s: %s' % (name, c))
+            if i.name is None:
+                i.name = '%s_%s_%s' % ('uniq' if i.unique else 'idx', tableName, '_'.join(i.columns))
+        attrs['__indexes__'] = indexes
+        relations = dict((k, v) for k, v in attrs.items() if isinstance(v, Relation))
+        for k in relations:#关系和列一样从类属性中移走,预取后的值存在实例字典里
+            if k in mappings:
+                raise Exception('Relation name conflicts with a field in %s: %s' % (name, k))
+            attrs.pop(k)
+        attrs['__relations__'] = relations
+        for k in ('__select__', '__insert__', '__update__', '__delete__'):#预先翻译好占位符,请求路径上只剩字典查找
+            _compile(attrs[k])
+        _models[name] = type.__new__(cls, name, bases, attrs)
+        return _models[name]#返回的是类实例，类似于类产生实例那样，然后该实例调用类的init方法，这个类实例也就是init里的self
         #总结即 将 原本User类中的attrs重新铸造了一遍
 
+class RowStream(object):
+    '''
+    Objects from Model.iterate. async for alone also works, but a loop left with break keeps the
+    connection until the stream is garbage-collected; async with returns it when the block exits.
+    '''
+
+    def __init__(self, rows):
+        self._rows = rows
+
+    def __aiter__(self):
+        return self._rows
+
+    async def __aenter__(self):
+        return self._rows
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._rows.aclose()
+        return False
+
+
 class Model(dict, metaclass=ModelMetaclass):
 
+    __count_cache__ = dict()#如 dict(ttl=10, estimate_above=100000), 为空则不缓存行数
+    __cache__ = dict()#如 dict(ttl=60, maxsize=10000), 为空则 find 不走跨请求缓存
+
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
+        object.__setattr__(self, '_dirty', set(kw))#自上次读取或写入后改过的列,构造时传入的列都算改过
+
+    @classmethod
+    def _fromRow(cls, r):
+        ' build an object from a database row, with no changed fields. '
+        obj = cls(**r)
+        obj._dirty.clear()
+        return obj
+
+    def clone(self):
+        ' a copy of this object that is not in the identity map, with the same changed fields. '
+        obj = self.__class__(**self)
+        obj._dirty.intersection_update(self._dirty)
+        return obj
 
     def __getattr__(self, key):
         try:
             return self[key]
         except KeyError:
+            if key in self.__mappings__:
+                raise AttributeError(r"'%s' object has not loaded column '%s', use await obj.load('%s')" % (self.__class__.__name__, key, key))
+            if key in self.__relations__:
+                raise AttributeError(r"'%s' object has not loaded relation '%s', use prefetch=('%s',)" % (self.__class__.__name__, key, key))
             raise AttributeError(r"'Model' object has no attribute '%s'" % key)
 
+    def __setitem__(self, key, value):
+        if key in self.__mappings__ and (key not in self or self[key] != value):#值没变的赋值不算修改
+            self._dirty.add(key)
+        super(Model, self).__setitem__(key, value)
+
     def __setattr__(self, key, value):
         self[key] = value
 
@@ -181,69 +776,416 @@ class Model(dict, metaclass=ModelMetaclass):
         return value
 
     @classmethod
-    async def findAll(cls, where=None, args=None, **kw):
-        ' find objects by where clause. '
-        sql = [cls.__select__]
+    def _register(cls, obj, columns):
+        ' keep an object with every column loaded in the identity map, returning the one already mapped for its key. '
+        m = _identity.get()
+        if m is None or len(set(columns)) != len(cls.__mappings__):
+            return obj
+        return m.setdefault((cls, obj[cls.__primary_key__]), obj)
+
+    @classmethod
+    def _relation(cls, name):
+        r = cls.__relations__.get(name)
+        if r is None:
+            raise ValueError('Invalid relation for %s: %s' % (cls.__name__, name))
+        return r
+
+    @classmethod
+    async def _prefetch(cls, objs, names, found=None):
+        ' load the named relations of objs, one IN query per relation, the relations concurrently. '
+        found = found or dict()#已经取回的关系: 名字 ==> {键: 值}
+        async def load(name):
+            r = cls._relation(name)
+            key = r.local_key(cls)
+            if name not in found:
+                keys = list(dict.fromkeys(o[key] for o in objs if o.get(key) is not None))
+                found[name] = await r.fetch(keys) if keys else dict()
+            for o in objs:
+                dict.__setitem__(o, name, found[name].get(o.get(key), r.empty()))
+        await _gather([load(name) for name in names])
+        return objs
+
+    @classmethod
+    def _columns(cls, columns, eager):
+        ' normalize a column projection to a tuple that always starts with the primary key. '
+        if columns is None:
+            return cls.__eager__ if eager else tuple([cls.__primary_key__] + cls.__fields__)
+        for c in columns:
+            if c not in cls.__mappings__:
+                raise ValueError('Invalid field for %s: %s' % (cls.__name__, c))
+        return tuple([cls.__primary_key__] + [c for c in columns if c != cls.__primary_key__])
+
+    @classmethod
+    def _selectHead(cls, columns):
+        sql = _shape_cache.get((cls, '_cols_', columns))
+        if sql is None:
+            sql = _cache_shape((cls, '_cols_', columns), 'select %s from `%s`' % (', '.join(map(lambda f: '`%s`' % f, columns)), cls.__table__))
+        return sql
+
+    @classmethod
+    def _seekClause(cls, orderBy, forward):
+        ' build the keyset condition and order for a (column value, primary key) cursor. '
+        parts = [_RE_ORDER_COLUMN.match(o) for o in (orderBy or '').split(',')]
+        m = parts[0]#只允许 '列 [方向]' 或 '列 方向, 主键 同方向' 两种排序
+        if None in parts or len(parts) > 2 or (len(parts) == 2 and (parts[1].group(1) != cls.__primary_key__ or (parts[1].group(2) or 'asc').lower() != (m.group(2) or 'asc').lower())):
+            raise ValueError('Keyset pagination needs orderBy on a single column: %s' % str(orderBy))
+        column = m.group(1)
+        desc = (m.group(2) or 'asc').lower() == 'desc'
+        if not forward:#向前翻页时反向扫描,取回后再倒序
+            desc = not desc
+        op, direction = ('<', 'desc') if desc else ('>', 'asc')
+        cond = '(`{c}` {op} ? or (`{c}` = ? and `{pk}` {op} ?))'.format(c=column, op=op, pk=cls.__primary_key__)
+        order = '`%s` %s, `%s` %s' % (column, direction, cls.__primary_key__, direction)
+        return cond, order
+
+    @classmethod
+    def _findAllSql(cls, columns, where, orderBy, limitForm, seek):
+        ' return the select statement for a query shape, built once and cached. '
+        key = (cls, columns, where, orderBy, limitForm, seek)
+        sql = _shape_cache.get(key)
+        if sql is not None:
+            return sql
+        if seek is not None:
+            cond, orderBy = cls._seekClause(orderBy, seek == 'after')
+            where = '(%s) and %s' % (where, cond) if where else cond
+        sql = [cls._selectHead(columns)]
         if where:
             sql.append('where')
             sql.append(where)
-        if args is None:
-            args = []
-        orderBy = kw.get('orderBy', None)
         if orderBy:
             sql.append('order by')
             sql.append(orderBy)
+        if limitForm == 1:
+            sql.append('limit ?')
+        elif limitForm == 2:
+            sql.append('limit ?, ?')
+        return _cache_shape(key, ' '.join(sql))
+
+    @classmethod
+    async def findAll(cls, where=None, args=None, **kw):
+        '''
+        find objects by where clause, optionally seeking after/before a (column value, primary key) cursor;
+        compact=True returns slotted rows; prefetch=('comments',) loads relations with one query each.
+        '''
+        args = list(args) if args else []
+        after, before = kw.get('after', None), kw.get('before', None)
+        if after is not None and before is not None:
+            raise ValueError('Use either after or before, not both.')
+        seek = after if after is not None else before
+        if seek is not None:
+            if not isinstance(seek, (tuple, list)) or len(seek) != 2:
+                raise ValueError('Invalid cursor value: %s' % str(seek))
+            args.extend([seek[0], seek[0], seek[1]])
         limit = kw.get('limit', None)
+        limitForm = None
         if limit is not None:
-            sql.append('limit')
             if isinstance(limit, int):
-                sql.append('?')
+                limitForm = 1
                 args.append(limit)
             elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?, ?')
+                limitForm = 2
                 args.extend(limit)
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = await select(' '.join(sql), args)
-        return [cls(**r) for r in rs]
+        columns = cls._columns(kw.get('columns', None), True)
+        sql = cls._findAllSql(columns, where, kw.get('orderBy', None), limitForm, None if seek is None else ('after' if after is not None else 'before'))
+        compact = kw.get('compact', False)
+        prefetch = kw.get('prefetch', None)
+        if compact and prefetch:
+            raise ValueError('Compact rows cannot hold prefetched relations.')
+        rs = await select(sql, args, as_tuple=compact)
+        if before is not None:
+            rs = rs[::-1]
+        if compact:#紧凑行: 元组游标直接按位置填入__slots__类
+            row = row_class(cls, columns)
+            return [row(*r) for r in rs]
+        objs = [cls._register(cls._fromRow(r), columns) for r in rs]
+        if prefetch and objs:
+            await cls._prefetch(objs, prefetch)
+        return objs
 
     @classmethod
-    async def findNumber(cls, selectField, where=None, args=None):
-        ' find number by select and where. '
-        sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
+    def iterate(cls, where=None, args=None, batch_size=500, **kw):
+        '''
+        iterate objects by where clause without loading the whole result:
+        async with Blog.iterate(...) as blogs: async for blog in blogs: ...
+        the streaming cursor keeps a connection until the block exits, even after break.
+        '''
+        return RowStream(cls._iterate(where, args, batch_size, **kw))
+
+    @classmethod
+    async def _iterate(cls, where, args, batch_size, **kw):
+        sql = [cls._selectHead(cls._columns(kw.get('columns', None), True))]
         if where:
             sql.append('where')
             sql.append(where)
-        rs = await select(' '.join(sql), args, 1)
+        orderBy = kw.get('orderBy', None)
+        if orderBy:
+            sql.append('order by')
+            sql.append(orderBy)
+        rows = select_iter(' '.join(sql), args, batch_size)
+        try:
+            async for r in rows:
+                yield cls._fromRow(r)
+        finally:#生成器被关闭时(RowStream退出时)关闭游标并归还连接
+            await rows.aclose()
+
+    @classmethod
+    async def findNumber(cls, selectField, where=None, args=None, ttl=None):
+        ' find number by select and where, cached for ttl seconds (default from __count_cache__). '
+        if ttl is None:
+            ttl = cls.__count_cache__.get('ttl', 0)
+        key = (selectField, where, tuple(args or ()))
+        if ttl > 0:
+            hit = _cached_count(cls.__table__, key)
+            if hit is not None:
+                return hit[0]
+        shape = (cls, '_num_', selectField, where)
+        sql = _shape_cache.get(shape)
+        if sql is None:
+            sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
+            if where:
+                sql.append('where')
+                sql.append(where)
+            sql = _cache_shape(shape, ' '.join(sql))
+        rs = await select(sql, args, 1)
         if len(rs) == 0:
             return None
-        return rs[0]['_num_']
+        num = rs[0]['_num_']
+        if ttl > 0:
+            _store_count(cls.__table__, key, num, ttl)
+        return num
+
+    @classmethod
+    async def findCount(cls, where=None, args=None):
+        ' count rows for pagination, return (num, exact); big unfiltered tables may use the information_schema estimate. '
+        threshold = cls.__count_cache__.get('estimate_above', None)
+        if where is None and threshold is not None and _backend.estimate_rows is not None:
+            key = ('table_rows', None, ())
+            hit = _cached_count(cls.__table__, key)
+            if hit is not None:
+                estimate = hit[0]
+            else:
+                rs = await select(_backend.estimate_rows, [cls.__table__], 1)
+                estimate = rs[0]['_num_'] if rs else None
+                _store_count(cls.__table__, key, estimate, cls.__count_cache__.get('estimate_ttl', 60))
+            if estimate is not None and estimate > threshold:
+                return estimate, False
+        return await cls.findNumber('count(`%s`)' % cls.__primary_key__, where, args), True
 
     @classmethod
-    async def find(cls, pk):
-        ' find object by primary key. '
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+    async def find(cls, pk, columns=None, prefetch=None):
+        '''
+        find object by primary key, loading all columns unless columns is given; full rows go through __cache__.
+        prefetch relations keyed by the primary key (HasMany) are queried together with the object.
+        '''
+        if prefetch:
+            early = [n for n in prefetch if cls._relation(n).local_key(cls) == cls.__primary_key__]
+            rs = await _gather([cls.find(pk, columns)] + [cls._relation(n).fetch([pk]) for n in early])
+            if rs[0] is None:
+                return None
+            return (await cls._prefetch([rs[0]], prefetch, dict(zip(early, rs[1:]))))[0]
+        m = _identity.get()
+        if m is not None and (cls, pk) in m:
+            return m[(cls, pk)]
+        cached = cls.__cache__ and columns is None and _tx.get() is None#事务内可能读到未提交的数据,不读也不写缓存
+        columns = cls._columns(columns, False)
+        if cached:
+            c = _model_cache(cls)
+            stats = _cache_stats.setdefault(cls.__name__, [0, 0])
+            r = await c.get(cls.__table__, str(pk))
+            if r is not None:
+                stats[0] += 1
+                return cls._register(cls._fromRow(r), columns)
+            stats[1] += 1
+        sql = _shape_cache.get((cls, '_pk_', columns))
+        if sql is None:
+            sql = _cache_shape((cls, '_pk_', columns), '%s where `%s`=?' % (cls._selectHead(columns), cls.__primary_key__))
+        rs = await select(sql, [pk], 1, primary=cached)#落后的从库可能还是写入前的行,缓存起来就撤销了写入时的失效
         if len(rs) == 0:
             return None
-        return cls(**rs[0])
+        if cached:
+            await c.set(cls.__table__, str(pk), dict(rs[0]), cls.__cache__.get('ttl', 60))
+        return cls._register(cls._fromRow(rs[0]), columns)
+
+    @classmethod
+    async def findMany(cls, pks, chunk_size=500, columns=None):
+        ' find objects by a list of primary keys, keeping order and None for missing keys. '
+        columns = cls._columns(columns, False)
+        if chunk_size < 1:
+            raise ValueError('Invalid chunk_size value: %s' % str(chunk_size))
+        pks = list(pks)
+        keys = list(dict.fromkeys(pks))#去重但保持顺序,每个主键只查一次
+        found = dict()
+        m = _identity.get()
+        if m is not None:#身份映射里已有的对象不再查询
+            for pk in keys:
+                if (cls, pk) in m:
+                    found[pk] = m[(cls, pk)]
+            keys = [pk for pk in keys if pk not in found]
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            rs = await select('%s where `%s` in (%s)' % (cls._selectHead(columns), cls.__primary_key__, create_args_string(len(chunk))), chunk)
+            for r in rs:
+                found[r[cls.__primary_key__]] = cls._register(cls._fromRow(r), columns)
+        return [found.get(pk) for pk in pks]
+
+    @classmethod
+    async def updateWhere(cls, set_exprs, where=None, args=None):
+        ' update all rows matching where clause in one statement, return affected rows. '
+        if args is None:
+            args = []
+        if isinstance(set_exprs, dict):#字典形式 {列名: 值} 编译为 `列`=? ,值排在where参数之前
+            for k in set_exprs:
+                if k not in cls.__mappings__:
+                    raise ValueError('Invalid field for %s: %s' % (cls.__name__, k))
+            args = list(set_exprs.values()) + list(args)
+            set_exprs = ', '.join(map(lambda k: '`%s`=?' % k, set_exprs))
+        if not set_exprs:
+            raise ValueError('Invalid set_exprs value: %s' % str(set_exprs))
+        sql = ['update `%s` set %s' % (cls.__table__, set_exprs)]
+        if where:
+            sql.append('where')
+            sql.append(where)
+        rows = await execute(' '.join(sql), args)
+        invalidate_counts(cls.__table__)
+        _forget(cls)
+        await _uncache(cls)
+        return rows
+
+    @classmethod
+    async def removeWhere(cls, where=None, args=None):
+        ' delete all rows matching where clause in one statement, return affected rows. '
+        sql = ['delete from `%s`' % cls.__table__]
+        if where:
+            sql.append('where')
+            sql.append(where)
+        rows = await execute(' '.join(sql), args or [])
+        invalidate_counts(cls.__table__)
+        _forget(cls)
+        await _uncache(cls)
+        return rows
 
     async def save(self):
         args = list(map(self.getValueOrDefault, self.__fields__))
         args.append(self.getValueOrDefault(self.__primary_key__))
         rows = await execute(self.__insert__, args)
+        invalidate_counts(self.__table__)
+        await _uncache(self.__class__, args[-1])
+        self._dirty.clear()
         if rows != 1:
             logging.warn('failed to insert record: affected rows: %s' % rows)
 
+    @classmethod
+    async def _insertChunks(cls, instances, chunk_size, tail=''):
+        ' insert instances with multi-row values, one statement per chunk with tail appended; return the affected rows. '
+        if chunk_size < 1:
+            raise ValueError('Invalid chunk_size value: %s' % str(chunk_size))
+        row = '(%s)' % create_args_string(len(cls.__fields__) + 1)
+        head = cls.__insert__[:cls.__insert__.rindex(' values ')]#复用元类生成的insert语句的列部分
+        affected = 0
+        for i in range(0, len(instances), chunk_size):
+            chunk = instances[i:i + chunk_size]
+            args = []
+            for obj in chunk:
+                args.extend(map(obj.getValueOrDefault, cls.__fields__))
+                args.append(obj.getValueOrDefault(cls.__primary_key__))
+            sql = '%s values %s' % (head, ', '.join([row] * len(chunk)))
+            affected += await execute('%s %s' % (sql, tail) if tail else sql, args)
+            for obj in chunk:
+                obj._dirty.clear()
+        invalidate_counts(cls.__table__)
+        return affected
+
+    @classmethod
+    async def saveMany(cls, instances, chunk_size=500):
+        ' insert many objects with multi-row values, one statement per chunk. '
+        instances = list(instances)
+        affected = await cls._insertChunks(instances, chunk_size)
+        if affected != len(instances):
+            logging.warn('failed to insert all records: affected rows: %s of %s' % (affected, len(instances)))
+        return affected
+
+    @classmethod
+    def _upsertClause(cls, update, conflict):
+        ' normalize the upsert options and return the backend clause, built once per shape. '
+        conflict = tuple(conflict or (cls.__primary_key__,))
+        update = tuple(f for f in cls.__fields__ if f not in conflict) if update is None else tuple(update)
+        for f in conflict + update:
+            if f not in cls.__mappings__:
+                raise ValueError('Invalid field for %s: %s' % (cls.__name__, f))
+        key = (cls, '_ups_', conflict, update, _backend.name)#两种数据库的写法不同
+        sql = _shape_cache.get(key)
+        if sql is None:
+            sql = _cache_shape(key, _backend.upsert(conflict, update))
+        return sql
+
+    async def upsert(self, update=None, conflict=None):
+        '''
+        insert the object, or on a duplicate key update the update columns (all but the conflict columns by default,
+        nothing with update=()); conflict names the unique key, the primary key by default.
+        Return the affected rows: 0 when a duplicate was left unchanged.
+        '''
+        clause = self._upsertClause(update, conflict)
+        args = list(map(self.getValueOrDefault, self.__fields__))
+        args.append(self.getValueOrDefault(self.__primary_key__))
+        rows = await execute('%s %s' % (self.__insert__, clause), args)
+        invalidate_counts(self.__table__)
+        _forget(self.__class__, None if conflict else args[-1])#按其它唯一键冲突时不知道被改的是哪一行
+        await _uncache(self.__class__, None if conflict else args[-1])
+        self._dirty.clear()
+        return rows
+
+    @classmethod
+    async def upsertMany(cls, instances, update=None, conflict=None, chunk_size=500):
+        ' upsert many objects with multi-row values, one statement per chunk; options as in upsert(). '
+        clause = cls._upsertClause(update, conflict)
+        affected = await cls._insertChunks(list(instances), chunk_size, clause)
+        _forget(cls)
+        await _uncache(cls)
+        return affected
+
+    async def load(self, *names):
+        ' load deferred (or any) columns of this object, e.g. await blog.load("content"). '
+        names = names or tuple(self.__deferred__)
+        columns = self._columns(names, False)
+        rs = await select('%s where `%s`=?' % (self._selectHead(columns), self.__primary_key__), [self.getValue(self.__primary_key__)], 1)
+        if len(rs) == 0:
+            raise KeyError('%s not found: %s' % (self.__class__.__name__, self.getValue(self.__primary_key__)))
+        for k in names:#从库里读到的值不算修改
+            dict.__setitem__(self, k, rs[0][k])
+            self._dirty.discard(k)
+        return self
+
     async def update(self):
-        args = list(map(self.getValue, self.__fields__))
+        ' write only the columns changed since the object was loaded or saved; no statement when nothing changed. '
+        fields = tuple(f for f in self.__fields__ if f in self._dirty)
+        if not fields:
+            return
+        args = list(map(self.getValue, fields))
         args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        if len(fields) == len(self.__fields__):
+            sql = self.__update__
+        else:#按修改过的列组合缓存语句
+            sql = _shape_cache.get((self.__class__, '_upd_', fields))
+            if sql is None:
+                sql = _cache_shape((self.__class__, '_upd_', fields), 'update `%s` set %s where `%s`=?' % (self.__table__, ', '.join(map(lambda f: '`%s`=?' % f, fields)), self.__primary_key__))
+        rows = await execute(sql, args)
+        invalidate_counts(self.__table__)
+        self._dirty.difference_update(fields)
+        await _uncache(self.__class__, args[-1])
+        m = _identity.get()
+        if m is not None and m.get((self.__class__, args[-1]), self) is not self:#映射里的另一个副本已过期
+            _forget(self.__class__, args[-1])
         if rows != 1:
             logging.warn('failed to update by primary key: affected rows: %s' % rows)
 
     async def remove(self):
         args = [self.getValue(self.__primary_key__)]
         rows = await execute(self.__delete__, args)
+        invalidate_counts(self.__table__)
+        _forget(self.__class__, args[0])
+        await _uncache(self.__class__, args[0])
         if rows != 1:
             logging.warn('failed to remove by primary key: affected rows: %s' % rows)
 
@@ -0,0 +1,129 @@
+'''
+Schema generation and index checks driven by the model mappings.
+
+    python3 schema.py [mysql|sqlite]      print create table / create index statements
+    python3 schema.py check <sqlite.db>   diff declared indexes against a SQLite stand-in database
+'''
+
+import re, sys, sqlite3
+
+import orm
+from orm import Model
+
+
+def all_models(module=None):
+    ' the Model subclasses defined in a module, models.py by default. '
+    if module is None:
+        import models as module
+    return [v for v in vars(module).values() if isinstance(v, type) and issubclass(v, Model) and v is not Model]
+
+def create_table_sql(model, dialect='mysql'):
+    columns = [model.__primary_key__] + model.__fields__
+    L = ['  `%s` %s not null' % (c, model.__mappings__[c].column_type) for c in columns]
+    L.append('  primary key (`%s`)' % model.__primary_key__)
+    sql = 'create table `%s` (\n%s\n)' % (model.__table__, ',\n'.join(L))
+    if dialect == 'mysql':
+        sql = sql + ' engine=innodb default charset=utf8'
+    return sql + ';'
+
+def create_index_sql(model):
+    return ['create %sindex `%s` on `%s` (%s);' % ('unique ' if i.unique else '', i.name, model.__table__, ', '.join('`%s`' % c for c in i.columns)) for i in model.__indexes__]
+
+def schema_sql(models=None, dialect='mysql'):
+    ' the full DDL of the given models as one script. '
+    L = []
+    for m in models or all_models():
+        L.append(create_table_sql(m, dialect))
+        L.extend(create_index_sql(m))
+    return '\n\n'.join(L) + '\n'
+
+## 读取线上库的索引,返回 {索引名: (列, ...)}
+async def mysql_indexes(model):
+    rs = await orm.select('select index_name _name_, column_name _column_ from information_schema.statistics where table_schema=database() and table_name=? order by index_name, seq_in_index', [model.__table__])
+    indexes = dict()
+    for r in rs:
+        indexes.setdefault(r['_name_'], []).append(r['_column_'])
+    return dict((k, tuple(v)) for k, v in indexes.items())
+
+async def live_indexes(model):
+    ' read the live indexes of a model through the orm pool of either backend. '
+    if orm.backend_name() != 'sqlite':
+        return await mysql_indexes(model)
+    indexes = dict()
+    for r in await orm.select('pragma index_list(`%s`)' % model.__table__, []):
+        rs = await orm.select('pragma index_info(`%s`)' % r['name'], [])
+        indexes[r['name']] = tuple(c['name'] for c in rs)
+    return indexes
+
+async def create_schema(models=None):
+    ' create the tables and indexes of the models through the orm pool, e.g. on a fresh sqlite database. '
+    for sql in schema_sql(models, orm.backend_name()).split(';'):
+        if sql.strip():
+            await orm.execute(sql.strip(), [])
+
+def sqlite_indexes(conn, model):
+    indexes = dict()
+    for row in conn.execute('pragma index_list(`%s`)' % model.__table__).fetchall():
+        name = row[1]
+        indexes[name] = tuple(r[2] for r in conn.execute('pragma index_info(`%s`)' % name).fetchall())
+    return indexes
+
+def diff_indexes(model, live):
+    '''
+    Compare declared indexes with live ones ({name: columns}) by column list.
+    Returns (missing declared indexes, live index names that are not declared).
+    '''
+    declared = dict((i.columns, i) for i in model.__indexes__)
+    live_columns = set(live.values())
+    missing = [i for c, i in declared.items() if c not in live_columns]
+    extra = [n for n, c in live.items() if c not in declared and c != (model.__primary_key__,) and n != 'PRIMARY']
+    return missing, extra
+
+_RE_WHERE_COLUMN = re.compile(r'`?(\w+)`?\s*(?:=|<|>|\bin\b|\blike\b|\bbetween\b)', re.IGNORECASE)
+
+def leading_columns(model, live=None):
+    ' first column of every usable index: the primary key plus the declared (or given live) indexes. '
+    indexes = [i.columns for i in model.__indexes__] if live is None else list(live.values())
+    return set([model.__primary_key__] + [c[0] for c in indexes if c])
+
+def unsupported_queries(models=None, live=None):
+    '''
+    Report the findAll/findNumber query shapes issued so far (see orm._shape_cache) whose where clause
+    or, without where, order by column is not the leading column of any index.
+    live maps a model to its live indexes; the declared ones are used otherwise.
+    '''
+    models = set(models or all_models())
+    report = []
+    for key, sql in list(orm._shape_cache.items()):
+        model = key[0]
+        if model not in models:
+            continue
+        if len(key) == 6:#findAll: (模型, 列, where, orderBy, limit形式, 游标方向)
+            where, orderBy = key[2], key[3]
+        elif len(key) == 4 and key[1] == '_num_':#findNumber: (模型, '_num_', selectField, where)
+            where, orderBy = key[3], None
+        else:
+            continue
+        lead = leading_columns(model, (live or {}).get(model))
+        if where:
+            cols = [c for c in _RE_WHERE_COLUMN.findall(where) if c in model.__mappings__]
+            if cols and not lead.intersection(cols):
+                report.append(dict(model=model.__name__, sql=sql, reason='no index leads with any of: %s' % ', '.join(cols)))
+        elif orderBy:
+            col = orderBy.split(',')[0].split()[0].strip('`')
+            if col in model.__mappings__ and col not in lead:
+                report.append(dict(model=model.__name__, sql=sql, reason='no index for order by %s' % col))
+    return report
+
+
+if '__main__' == __name__:
+    if len(sys.argv) > 2 and sys.argv[1] == 'check':
+        conn = sqlite3.connect(sys.argv[2])
+        for m in all_models():
+            missing, extra = diff_indexes(m, sqlite_indexes(conn, m))
+            for i in missing:
+                print('%s: missing %s' % (m.__table__, i))
+            for n in extra:
+                print('%s: undeclared index %s' % (m.__table__, n))
+    else:
+        print(schema_sql(dialect=sys.argv[1] if len(sys.argv) > 1 else 'mysql'), end='')
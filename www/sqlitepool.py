@@ -0,0 +1,194 @@
+'''
+A small aiomysql-compatible connection pool over the standard sqlite3 module, used by the orm 'sqlite' backend
+for local benchmarks and tests. Each connection runs its statements on its own worker thread.
+'''
+
+import asyncio, logging, sqlite3, itertools, collections
+from concurrent.futures import ThreadPoolExecutor
+
+
+## 游标类型标记,与 aiomysql.Cursor / DictCursor / SSDictCursor 对应
+class Cursor(object):
+    as_dict = False
+
+class DictCursor(Cursor):
+    as_dict = True
+
+class SSDictCursor(DictCursor):
+    pass
+
+
+def _concat(*args):#SQLite 没有 MySQL 的 concat(),任一参数为NULL时结果为NULL
+    if None in args:
+        return None
+    return ''.join(map(str, args))
+
+
+class _Cursor(object):
+
+    def __init__(self, conn, cursor_class):
+        self._conn = conn
+        self._as_dict = cursor_class.as_dict
+        self._cur = None
+        self.rowcount = -1
+        self.description = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def execute(self, sql, args=()):
+        def run():
+            self._cur = self._conn._db.execute(sql, tuple(args or ()))
+            return self._cur.rowcount, self._cur.description
+        self.rowcount, self.description = await self._conn._run(run)
+        return self.rowcount
+
+    def _rows(self, rows):
+        if not self._as_dict:
+            return rows
+        names = [d[0] for d in self.description]
+        return [dict(zip(names, r)) for r in rows]
+
+    async def fetchall(self):
+        return self._rows(await self._conn._run(self._cur.fetchall))
+
+    async def fetchmany(self, size):
+        return self._rows(await self._conn._run(self._cur.fetchmany, size))
+
+    async def fetchone(self):
+        rs = await self.fetchmany(1)
+        return rs[0] if rs else None
+
+    async def close(self):
+        if self._cur is not None:
+            cur, self._cur = self._cur, None
+            await self._conn._run(cur.close)
+
+
+class Connection(object):
+
+    def __init__(self, loop, database):
+        self._loop = loop
+        self._executor = ThreadPoolExecutor(max_workers=1)#sqlite3连接只在自己的线程里使用
+        self._database = database
+        self._db = None
+
+    async def _open(self):
+        def connect():
+            db = sqlite3.connect(self._database, uri=True, isolation_level=None, check_same_thread=False)
+            db.create_function('concat', -1, _concat)
+            return db
+        self._db = await self._run(connect)
+        return self
+
+    def _run(self, fn, *args):
+        return self._loop.run_in_executor(self._executor, fn, *args)
+
+    def cursor(self, cursor_class=Cursor):
+        return _Cursor(self, cursor_class)
+
+    async def begin(self):
+        await self._run(self._db.execute, 'begin')
+
+    async def commit(self):
+        if self._db.in_transaction:
+            await self._run(self._db.commit)
+
+    async def rollback(self):
+        if self._db.in_transaction:
+            await self._run(self._db.rollback)
+
+    async def close(self):
+        await self._run(self._db.close)
+        self._executor.shutdown(wait=False)
+
+
+class _PoolConnectionContext(object):
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = None
+
+    async def __aenter__(self):
+        self._conn = await self._pool.acquire()
+        return self._conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._pool.release(self._conn)
+
+
+class Pool(object):
+
+    def __init__(self, loop, database, minsize, maxsize):
+        self._loop = loop
+        self._database = database
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self._free = []
+        self._all = []
+        self._waiters = collections.deque()
+
+    @property
+    def size(self):
+        return len(self._all)
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    def get(self):
+        return _PoolConnectionContext(self)
+
+    async def acquire(self):
+        if self._free:
+            return self._free.pop()
+        if len(self._all) < self.maxsize:
+            conn = Connection(self._loop, self._database)
+            self._all.append(conn)
+            try:
+                return await conn._open()
+            except BaseException:
+                self._all.remove(conn)
+                raise
+        fut = self._loop.create_future()#连接用尽时排队等待归还
+        self._waiters.append(fut)
+        return await fut
+
+    def release(self, conn):
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(conn)
+                return
+        self._free.append(conn)
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        for conn in self._all:
+            await conn.close()
+        self._all, self._free = [], []
+
+
+_memory_ids = itertools.count()
+
+async def create_pool(database, minsize=1, maxsize=10, loop=None):
+    '''
+    Create a pool on a SQLite file, or on a shared in-memory database for ':memory:'.
+    '''
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    if database == ':memory:':#每个连接默认各自一个内存库,改用共享缓存让池内连接看到同一个库
+        database = 'file:orm_memory_%d?mode=memory&cache=shared' % next(_memory_ids)
+    elif not database.startswith('file:'):
+        database = 'file:%s' % database
+    logging.info('create sqlite connection pool on %s...' % database)
+    pool = Pool(loop, database, minsize, maxsize)
+    conns = [await pool.acquire() for n in range(max(minsize, 1))]#内存库在最后一个连接关闭前一直存在,连接池不主动关连接
+    for conn in conns:
+        pool.release(conn)
+    return pool